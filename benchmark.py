@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""benchmark.py
+
+Benchmark the throughput and peak memory of the row-level duty_csv functions
+using synthetic describe payloads and pan number lists, with dxpy mocked out,
+and compare the results with a saved baseline so regressions are visible
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from unittest import mock
+import config
+import duty_csv
+from deadline import Deadline
+from profiler import StageProfiler
+
+# Not configured, so log messages from the benchmarked functions are dropped
+logger = duty_csv.logger
+
+
+class FakeDXFile:
+    """
+    Stand-in for dxpy.DXFile that returns a URL without contacting DNAnexus
+
+    Methods
+        get_download_url()
+            Return a URL for the file
+    """
+
+    def __init__(self, file_id: str):
+        """
+        Constructor for the FakeDXFile class
+            :param file_id (str):   DNAnexus file ID
+        """
+        self.file_id = file_id
+
+    def get_download_url(self, filename: str, **kwargs) -> list:
+        """
+        Return a URL for the file
+            :param filename (str):  File name
+            :return (list):         URL and headers, as returned by dxpy
+        """
+        return [f"https://dl.dnanex.us/F/D/{self.file_id}/{filename}", {}]
+
+
+class Benchmarks:
+    """
+    Run each benchmark at each size, measuring the best wall time over the
+    config-defined number of repeats and the peak traced memory of a separate
+    run. Each benchmark is set up outside of the measured call, so only the
+    benchmarked function is measured. Sizes are the number of rows (files)
+    for the dataframe and CSV benchmarks, the number of calls for get_runtype
+    and get_trust_dirs, and the number of pan numbers for
+    update_tso_config_regex
+
+    Methods
+        run()
+            Run the benchmarks and return the results
+        measure()
+            Measure the wall time and peak memory of a benchmarked call
+        get_output()
+            Return a GenerateOutput set up for a number of synthetic files
+        get_data_obj_dict()
+            Return synthetic data objects for a number of files
+        bench_get_runtype()
+        bench_get_trust_dirs()
+        bench_update_tso_config_regex()
+        bench_create_url_dataframe()
+        bench_create_csv()
+        bench_create_chrome_download_cmds()
+            Set up a benchmark at a size, returning the call to measure
+    """
+
+    RUNTYPE = "CustomPanels"
+    PANNUMBERS = [f"Pan{4000 + number}" for number in range(50)]
+
+    def __init__(self, sizes: list, repeats: int, workdir: str):
+        """
+        Constructor for the Benchmarks class
+            :param sizes (list):    Sizes to run each benchmark at
+            :param repeats (int):   Number of timed runs per benchmark and size
+            :param workdir (str):   Directory to write benchmark outputs to
+        """
+        self.sizes = sizes
+        self.repeats = repeats
+        self.workdir = workdir
+        self.benchmarks = {
+            name[len("bench_") :]: getattr(self, name)
+            for name in dir(self)
+            if name.startswith("bench_")
+        }
+
+    def run(self, names: list | None) -> dict:
+        """
+        Run the benchmarks and return the results
+            :param names (list | None): Benchmarks to run, or None for all
+            :return results (dict):     Dictionary of benchmark: size:
+                                        {"seconds", "peak_bytes"}
+        """
+        results = {}
+        with mock.patch.object(duty_csv.dxpy, "DXFile", FakeDXFile):
+            for name, bench in self.benchmarks.items():
+                if names and name not in names:
+                    continue
+                results[name] = {}
+                for size in self.sizes:
+                    seconds, peak_bytes = self.measure(bench(size))
+                    results[name][str(size)] = {
+                        "seconds": seconds,
+                        "peak_bytes": peak_bytes,
+                    }
+                    print(
+                        f"{name:<36}{size:>8}{seconds:>12.4f}s"
+                        f"{size / seconds:>14.0f}/s{peak_bytes / 1024 / 1024:>10.2f}MB"
+                    )
+        return results
+
+    def measure(self, call: callable) -> tuple[float, int]:
+        """
+        Measure the best wall time over the repeats, and the peak traced
+        memory of a separate run, of a benchmarked call
+            :param call (callable): Benchmarked call
+            :return seconds (float):    Best wall time in seconds
+            :return peak_bytes (int):   Peak traced memory in bytes
+        """
+        timings = []
+        for _ in range(self.repeats):
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            call()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return min(timings), peak_bytes
+
+    def get_output(self, size: int) -> duty_csv.GenerateOutput:
+        """
+        Return a GenerateOutput set up for a number of synthetic files,
+        without running the pipeline
+            :param size (int):  Number of files
+            :return output (obj):   GenerateOutput instance
+        """
+        output = duty_csv.GenerateOutput.__new__(duty_csv.GenerateOutput)
+        output.project_name = "NGS600_run"
+        output.project_id = "project-000000000000000000000000"
+        output.runtype = self.RUNTYPE
+        output.script_mode = "TEST"
+        output.stg_pannumbers = self.PANNUMBERS[:10]
+        output.cp_capture_pannos = self.PANNUMBERS[10:20]
+        output.deadline = Deadline(None)
+        output.missing_files = []
+        output.url_calls = None
+        output.profiler = StageProfiler(os.path.join(self.workdir, "benchmark"), False)
+        output.incomplete = []
+        output.data_obj_dict = self.get_data_obj_dict(size)
+        output.csvfile_path = os.path.join(self.workdir, "benchmark.duty_csv.csv")
+        output.txtfile_path = os.path.join(self.workdir, "benchmark.duty_csv.txt")
+        return output
+
+    def get_data_obj_dict(self, size: int) -> dict:
+        """
+        Return synthetic data objects for a number of files, shaped like the
+        find_data_objects results, split across the runtype's file types
+            :param size (int):          Number of files
+            :return data_obj_dict (dict):   Dictionary of file type: list of
+                                            data objects
+        """
+        filetypes = list(config.PER_RUNTYPE_DOWNLOADS[self.RUNTYPE])
+        data_obj_dict = {filetype: [] for filetype in filetypes}
+        for number in range(size):
+            filetype = filetypes[number % len(filetypes)]
+            file_id = f"file-{number:024d}"
+            data_obj_dict[filetype].append(
+                {
+                    "id": file_id,
+                    "project": "project-000000000000000000000000",
+                    "describe": {
+                        "id": file_id,
+                        "name": (
+                            f"NGS600_{number % 96:02d}_{number}_AB_M_VCP1_"
+                            f"{self.PANNUMBERS[number % 50]}_S{number}.{filetype}.txt"
+                        ),
+                        "folder": config.PER_RUNTYPE_DOWNLOADS[self.RUNTYPE][filetype][
+                            "folder"
+                        ],
+                        "size": 1024 * number,
+                        "parts": {"1": {"md5": "0" * 32, "size": 1024 * number}},
+                    },
+                }
+            )
+        return data_obj_dict
+
+    def bench_get_runtype(self, size: int) -> callable:
+        """
+        Set up get_runtype for a number of project names
+            :param size (int):      Number of calls
+            :return (callable):     Benchmarked call
+        """
+        output = self.get_output(0)
+        project_names = [f"{number}_NGS600_run" for number in range(size)]
+
+        def call():
+            for project_name in project_names:
+                output.project_name = project_name
+                output.get_runtype()
+
+        return call
+
+    def bench_get_trust_dirs(self, size: int) -> callable:
+        """
+        Set up get_trust_dirs for a number of URLs
+            :param size (int):      Number of calls
+            :return (callable):     Benchmarked call
+        """
+        output = self.get_output(0)
+        urls = [
+            (
+                "exon_level_coverage",
+                f"https://dl.dnanex.us/F/D/file-{number}/NGS600_01_"
+                f"{self.PANNUMBERS[number % 50]}.exon_level.txt",
+            )
+            for number in range(size)
+        ]
+
+        def call():
+            for filetype, url in urls:
+                output.get_trust_dirs(filetype, url)
+
+        return call
+
+    def bench_update_tso_config_regex(self, size: int) -> callable:
+        """
+        Set up update_tso_config_regex for a number of pan numbers
+            :param size (int):      Number of pan numbers
+            :return (callable):     Benchmarked call
+        """
+        pannumbers = [f"Pan{number}" for number in range(size)]
+        return lambda: duty_csv.update_tso_config_regex(pannumbers)
+
+    def bench_create_url_dataframe(self, size: int) -> callable:
+        """
+        Set up create_url_dataframe for a number of files
+            :param size (int):      Number of files
+            :return (callable):     Benchmarked call
+        """
+        return self.get_output(size).create_url_dataframe
+
+    def bench_create_csv(self, size: int) -> callable:
+        """
+        Set up create_csv for a number of files
+            :param size (int):      Number of files
+            :return (callable):     Benchmarked call
+        """
+        output = self.get_output(size)
+        output.url_dataframe = output.create_url_dataframe()
+        return output.create_csv
+
+    def bench_create_chrome_download_cmds(self, size: int) -> callable:
+        """
+        Set up create_chrome_download_cmds for a number of files
+            :param size (int):      Number of files
+            :return (callable):     Benchmarked call
+        """
+        output = self.get_output(size)
+        output.url_dataframe = output.create_url_dataframe()
+        return output.create_chrome_download_cmds
+
+
+def compare(results: dict, baseline: dict) -> list:
+    """
+    Compare benchmark results with the baseline, returning the regressions
+    where the wall time or peak memory exceeds the baseline by more than the
+    config-defined tolerance, and the results with no baseline. Wall time
+    increases smaller than the config-defined floor are ignored, as timings
+    of the smallest sizes are dominated by noise
+        :param results (dict):      Benchmark results
+        :param baseline (dict):     Baseline benchmark results
+        :return regressions (list): List of regression descriptions
+    """
+    regressions = []
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            base = baseline.get(name, {}).get(size)
+            if not base:
+                regressions.append(
+                    f"{name} at size {size}: no baseline. Run with --save to save one"
+                )
+                continue
+            for metric, tolerance, floor in (
+                (
+                    "seconds",
+                    config.BENCHMARK_TIME_TOLERANCE,
+                    config.BENCHMARK_TIME_FLOOR,
+                ),
+                ("peak_bytes", config.BENCHMARK_MEMORY_TOLERANCE, 0),
+            ):
+                if (
+                    result[metric] > base[metric] * (1 + tolerance)
+                    and result[metric] - base[metric] > floor
+                ):
+                    regressions.append(
+                        f"{name} at size {size}: {metric} {result[metric]:.4g} "
+                        f"exceeds baseline {base[metric]:.4g} by more than "
+                        f"{tolerance:.0%}"
+                    )
+    return regressions
+
+
+def arg_parse() -> dict:
+    """
+    Parse arguments supplied by the command line. Create argument parser,
+    define command line arguments, then parse supplied command line arguments
+    using the created argument parser
+        :return (dict): Parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark the row-level duty_csv functions and compare the "
+            "results with a saved baseline"
+        )
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmarks",
+        type=str,
+        nargs="+",
+        help="Benchmarks to run (default all)",
+        default=None,
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        help="Sizes to run each benchmark at",
+        default=config.BENCHMARK_SIZES,
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        help="Number of timed runs per benchmark and size",
+        default=config.BENCHMARK_REPEATS,
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="Path of the baseline file",
+        default=os.path.join(os.getcwd(), config.BENCHMARK_BASELINE),
+    )
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help="Save the results as the baseline",
+        default=False,
+    )
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+
+    print(f"{'Benchmark':<36}{'Size':>8}{'Time':>13}{'Rate':>16}{'Peak':>12}")
+    with tempfile.TemporaryDirectory() as workdir:
+        results = Benchmarks(args["sizes"], args["repeats"], workdir).run(
+            args["benchmarks"]
+        )
+
+    if args["save"]:
+        baseline = {}
+        if os.path.exists(args["baseline"]):
+            with open(args["baseline"], encoding="utf-8") as baseline_file:
+                baseline = json.load(baseline_file)
+        for name, sizes in results.items():
+            baseline.setdefault(name, {}).update(sizes)
+        with open(args["baseline"], "w", encoding="utf-8") as baseline_file:
+            json.dump(baseline, baseline_file, indent=4)
+        print(f"Baseline saved to {args['baseline']}")
+    elif os.path.exists(args["baseline"]):
+        with open(args["baseline"], encoding="utf-8") as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against baseline {args['baseline']}")
+    else:
+        print(f"No baseline found at {args['baseline']}. Run with --save to save one")
+        sys.exit(1)
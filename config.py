@@ -6,6 +6,7 @@ import os
 DOCUMENT_ROOT = os.path.dirname(os.path.realpath(__file__))
 TEMPLATE_DIR = os.path.join(DOCUMENT_ROOT, "templates")
 EMAIL_TEMPLATE = "email.html"
+POWERSHELL_TEMPLATE = "download.ps1"
 LOGGING_FORMATTER = "%(asctime)s - %(levelname)s - %(message)s"
 
 PROJECT_PATTERN = r"(project-\S+)__\S+__"
@@ -25,6 +26,135 @@ EMAIL_RECIPIENT = {
 SMTP_DO_TLS = True
 
 COLS = ["Name", "Folder", "Type", "Url", "GSTT_dir", "subdir"]
+# Columns carried in the urls dataframe for use by the script, but not written
+# to the CSV file. Size, MD5 and Parts are taken from the DNAnexus describe,
+# Expires is the time (seconds since epoch) at which the URL expires
+INTERNAL_COLS = ["Size", "MD5", "Parts", "File_ID", "Expires"]
+# Describe fields requested for data objects. Upload parts are requested for
+# their MD5 checksums, as DNAnexus only holds a whole-file MD5 for symlinks
+DATA_OBJ_DESCRIBE = {"defaultFields": True, "fields": {"parts": True}}
+
+URL_DURATION = 60 * 60 * 24 * 5  # 60 sec x 60 min x 24 hours x 5 days
+
+# Assumed download bandwidth (bytes/sec) at the trust end, and the fraction of
+# the URL lifetime a single CSV shard is allowed to take to download. Used to
+# size shards so that each one finishes downloading before its URLs expire
+DOWNLOAD_BANDWIDTH = 10 * 1024 * 1024
+SHARD_EXPIRY_FRACTION = 0.5
+# Permitted imbalance between the largest shard and an equal share of the
+# total bytes before rows for the same destination directory are split
+# across shards
+SHARD_BALANCE_TOLERANCE = 0.1
+
+# Settings for the built-in downloader
+DOWNLOAD_THREADS = 8
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_RETRY_DELAY = 5  # Seconds, multiplied by the attempt number
+DOWNLOAD_TIMEOUT = 60  # Seconds to wait for the server to respond
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Settings for waiting for all executions in a project to finish
+TERMINAL_JOB_STATES = ["done", "failed", "terminated"]
+JOB_POLL_INTERVAL = 60  # Seconds between polls
+JOB_WAIT_TIMEOUT = 60 * 60 * 24  # Seconds to wait before giving up
+
+# Settings for profiling run stages
+PROFILE_TOP_N = 25  # Number of top allocations written per stage
+PROFILE_TRACEBACK_FRAMES = 1  # Frames stored per traced allocation
+
+# Settings for the long-running service mode
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8080
+SERVICE_WORKERS = 2
+SERVICE_LOGFILE = "duty_csv_service.log"
+
+# Pattern capturing the sample name from a file name, for the per-sample file
+# matrix in the email. Files without a sample name are counted against
+# RUN_LEVEL_SAMPLE
+SAMPLE_PATTERN = r"^([A-Z]+\d+_\d+_\S+?_Pan\d+)"
+RUN_LEVEL_SAMPLE = "Run-level files"
+
+# Settings for the end-to-end deadline for a run. Each slow stage must finish
+# by its fraction of RUN_DEADLINE seconds from the start of the run, leaving
+# time to write the outputs and send the email. Files whose URLs were not
+# created in time are listed in the CSV with the DEADLINE_MISSING_URL
+# placeholder, which the refresh mode re-mints, and the run exits with
+# DEADLINE_EXIT_CODE
+RUN_DEADLINE = 60 * 60 * 2
+DEADLINE_STAGE_FRACTIONS = {
+    "get_jobs": 0.1,
+    "get_data_dicts": 0.3,
+    "create_url_dataframe": 0.8,
+}
+DEADLINE_MISSING_URL = "MISSING:{file_id}"
+DEADLINE_EXIT_CODE = 3
+URL_THREADS = 8  # Threads used to create URLs
+
+# Settings for searching DNAnexus. Search results are fetched on a background
+# thread into a buffer of at most SEARCH_BUFFER results. DNAnexus returns at
+# most 1000 results per page, so the buffer holds the next page while the
+# current page is processed
+SEARCH_BUFFER = 2000
+SEARCH_PUT_TIMEOUT = 0.1  # Seconds between checks for a closed search
+
+# Settings for refreshing the URLs in an existing duty CSV. URLs expiring
+# within REFRESH_MARGIN seconds are treated as expired, so that they do not
+# expire part way through downloading
+REFRESH_MARGIN = 60 * 60 * 12
+REFRESH_THREADS = 8
+
+# URL used in place of a DNAnexus URL when replaying a snapshot, so that
+# outputs can be generated offline
+SNAPSHOT_URL = "https://snapshot.invalid/{file_id}/{file_name}"
+
+# Settings for digest emails. Runs with the digest flag spool their email
+# contents to DIGEST_DIR/<mode>, and digest.py sends one combined email per
+# mode once the oldest spooled run has waited DIGEST_WINDOW seconds
+DIGEST_DIR = "duty_csv_digest"
+DIGEST_WINDOW = 60 * 30
+DIGEST_POLL_INTERVAL = 60
+DIGEST_SUBJECT = {
+    "TEST": "TEST MODE. Duty digest: {} runs",
+    "PROD": "Duty digest: {} runs",
+}
+DIGEST_LOGFILE = "duty_csv_digest.log"
+
+# Settings for benchmark.py. Results exceeding the saved baseline by more
+# than the tolerance (fraction), and by more than BENCHMARK_TIME_FLOOR seconds
+# for wall time, are reported as regressions. Wall time varies between runs
+# and machines, so the time tolerance and floor only catch large slowdowns
+BENCHMARK_SIZES = [10, 100, 1000, 10000, 100000]
+BENCHMARK_REPEATS = 5
+BENCHMARK_BASELINE = "benchmark_baseline.json"
+BENCHMARK_TIME_TOLERANCE = 1.0
+BENCHMARK_MEMORY_TOLERANCE = 0.1
+BENCHMARK_TIME_FLOOR = 0.05  # Seconds, smaller time increases are ignored
+
+# Settings for the host-wide DNAnexus request rate limit, shared through a
+# SQLite file by all duty_csv processes using the same file (including
+# containers mounting the same directory). A rate of 0 disables the limit
+DX_RATE_LIMIT = 20  # Requests per second
+DX_RATE_BURST = 40  # Requests that can be made at once after a quiet period
+DX_RATE_LIMIT_DB = "duty_csv_rate_limit.sqlite"
+DX_RATE_LIMIT_DB_TIMEOUT = 30  # Seconds to wait for the database write lock
+
+# Settings for the SQLite work queue shared by workers. Leases not extended by
+# a heartbeat within QUEUE_LEASE seconds expire so another worker can claim
+# the project. A worker sending an email holds a sending lease for
+# QUEUE_EMAIL_LEASE seconds, which must be shorter than QUEUE_LEASE less
+# QUEUE_HEARTBEAT_INTERVAL so that it has expired by the time another worker
+# can claim the project
+QUEUE_DB = "duty_csv_queue.sqlite"
+QUEUE_DB_TIMEOUT = 30  # Seconds to wait for the database write lock
+QUEUE_LEASE = 10 * 60
+QUEUE_HEARTBEAT_INTERVAL = 60
+QUEUE_POLL_INTERVAL = 60
+QUEUE_MAX_ATTEMPTS = 3
+QUEUE_EMAIL_LEASE = 5 * 60
+
+# Settings for the generated powershell download script
+POWERSHELL_MAX_JOBS = 4
+POWERSHELL_RETRIES = 3
 
 # Signifies what identifies the runfolder name as being that run type - both
 # substrings that must be present and substrings that must be absent
@@ -94,6 +224,10 @@ PER_RUNTYPE_DOWNLOADS = {
     **dict.fromkeys(["ArcherDX", "OncoDEEP", "DEV"], False),
 }
 
+# TSO500 file types whose regex is populated with the command-line parsed
+# Synnovis pan numbers
+TSO_PAN_FILETYPES = ["gene_level_coverage", "exon_level_coverage"]
+
 P_BIOINF_TESTING = "P:/Bioinformatics/testing/process_duty_csv"
 
 GSTT_PATHS = {
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""deadline.py
+
+End-to-end deadline for a duty_csv run, split across the slow stages of the
+run, so that a run that overruns produces outputs for what completed rather
+than holding up duty
+"""
+import time
+import queue
+import threading
+import config
+
+
+class Deadline:
+    """
+    End-to-end deadline for a run. Each slow stage must finish by the
+    config-defined fraction of the deadline, measured from the start of the
+    run, so time saved by earlier stages is available to later stages and
+    time is left over to write the outputs and send the email
+
+    Methods
+        remaining()
+            Return the seconds remaining for a stage
+        start_calls()
+            Start worker threads calling a function for each set of arguments
+            submitted
+    """
+
+    def __init__(self, seconds: int | None):
+        """
+        Constructor for the Deadline class
+            :param seconds (int | None):    Deadline for the whole run in
+                                            seconds, or None for no deadline
+        """
+        self.seconds = seconds
+        self.start = time.monotonic()
+
+    def remaining(self, stage: str) -> float | None:
+        """
+        Return the seconds remaining before the deadline for a stage. Stages
+        without a config-defined fraction may use the whole deadline
+            :param stage (str):             Stage name
+            :return (float | None):         Seconds remaining, or None if
+                                            there is no deadline
+        """
+        if not self.seconds:
+            return None
+        fraction = config.DEADLINE_STAGE_FRACTIONS.get(stage, 1)
+        return max(0.0, self.start + self.seconds * fraction - time.monotonic())
+
+    def start_calls(self, function: callable, threads: int) -> "DeadlineCalls":
+        """
+        Start worker threads calling a function for each set of arguments
+        submitted, so calls can be made while the arguments are still being
+        gathered (e.g. as search results arrive)
+            :param function (callable): Function to call
+            :param threads (int):       Number of worker threads
+            :return (obj):              DeadlineCalls object
+        """
+        return DeadlineCalls(self, function, threads)
+
+
+class DeadlineCalls:
+    """
+    Calls of a function made on worker threads for sets of arguments
+    submitted while earlier calls are running. Worker threads are daemon
+    threads, so calls that are still hanging at the deadline do not stop the
+    run from exiting
+
+    Methods
+        submit()
+            Submit a call, unless a call with the same key has been submitted
+        work()
+            Make the submitted calls until the calls are stopped
+        wait()
+            Return the results of the calls that finished before the stage
+            deadline, and stop the worker threads
+    """
+
+    def __init__(self, deadline: Deadline, function: callable, threads: int):
+        """
+        Constructor for the DeadlineCalls class
+            :param deadline (obj):      Deadline object
+            :param function (callable): Function to call
+            :param threads (int):       Number of worker threads
+        """
+        self.deadline = deadline
+        self.function = function
+        self.tasks = queue.Queue()
+        self.keys = set()
+        self.results, self.errors = {}, []
+        self.finished = threading.Condition()
+        self.stopped = threading.Event()
+        self.threads = threads
+        for _ in range(threads):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, key, args: tuple) -> None:
+        """
+        Submit a call, unless a call with the same key has been submitted
+            :param key:             Hashable key the result is returned under
+            :param args (tuple):    Arguments for the call
+        """
+        if key not in self.keys:
+            self.keys.add(key)
+            self.tasks.put((key, args))
+
+    def work(self) -> None:
+        """
+        Make the submitted calls until the calls are stopped, or a call raises
+        an exception
+        """
+        while True:
+            task = self.tasks.get()
+            if task is None or self.stopped.is_set():
+                return
+            key, args = task
+            try:
+                result = self.function(*args)
+            except BaseException as exception:
+                with self.finished:
+                    self.errors.append(exception)
+                    self.finished.notify()
+                return
+            with self.finished:
+                self.results[key] = result
+                self.finished.notify()
+
+    def wait(self, stage: str) -> dict:
+        """
+        Return the results of the calls that finished before the stage
+        deadline, and stop the worker threads. The first exception raised by
+        a call (including SystemExit) is raised here
+            :param stage (str):     Stage name
+            :return results (dict): Dictionary of key: result, for calls that
+                                    finished
+        """
+        remaining = self.deadline.remaining(stage)
+        end = None if remaining is None else time.monotonic() + remaining
+        with self.finished:
+            while len(self.results) < len(self.keys) and not self.errors:
+                wait = None if end is None else end - time.monotonic()
+                if wait is not None and wait <= 0:
+                    break
+                self.finished.wait(wait)
+            self.stopped.set()
+            results, errors = dict(self.results), list(self.errors)
+        # Wake idle worker threads so they exit
+        for _ in range(self.threads):
+            self.tasks.put(None)
+        if errors:
+            raise errors[0]
+        return results
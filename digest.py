@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""digest.py
+
+Send the emails spooled by duty_csv runs with the digest flag as one combined
+email per script mode, containing one section per project and the
+attachments from all projects
+"""
+import os
+import sys
+import json
+import time
+import glob
+import smtplib
+import argparse
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+import config
+import duty_csv
+from logger import Logger
+
+# Configured by logger.Logger when the scheduler is started
+logger = duty_csv.logger
+
+
+class DigestScheduler:
+    """
+    Collect the emails spooled by duty_csv runs and send one combined email
+    per script mode (and therefore per recipient). A digest is sent once the
+    oldest spooled run for the mode has waited for the digest window, so each
+    run's email is delayed by at most the window. All digests due at the same
+    time are sent over a single SMTP session. The spooled runs for a mode are
+    removed as soon as its digest has been sent, so only the digests that
+    failed to send are retried on the next poll
+
+    Methods
+        run()
+            Send digests as they fall due, or send all spooled runs and exit
+        flush()
+            Send the digests that are due
+        get_due()
+            Return the spooled runs per script mode that are due to be sent
+        get_message_obj()
+            Create the combined message object for a script mode
+        send_emails()
+            Send digests over a single SMTP session, removing the spooled
+            runs of each digest once it has been sent
+    """
+
+    def __init__(self, spool_dir: str, window: int, email_user: str, email_pw: str):
+        """
+        Constructor for the DigestScheduler class
+            :param spool_dir (str):     Digest spool directory
+            :param window (int):        Seconds the oldest spooled run for a
+                                        script mode waits before the digest
+                                        is sent
+            :param email_user (str):    Mail server username
+            :param email_pw (str):      Mail server password
+        """
+        self.spool_dir = spool_dir
+        self.window = window
+        self.email_user = email_user
+        self.email_pw = email_pw
+        self.template = duty_csv.get_template(config.EMAIL_TEMPLATE, autoescape=True)
+
+    def run(self, once: bool) -> None:
+        """
+        Send digests as they fall due, polling the spool directory
+        indefinitely, or send all spooled runs immediately and exit
+            :param once (bool): Send all spooled runs regardless of the
+                                window, then exit
+        """
+        if once:
+            if not self.flush(force=True):
+                sys.exit(1)
+            return
+        logger.info(f"Sending digests of runs spooled in {self.spool_dir}")
+        while True:
+            self.flush(force=False)
+            time.sleep(config.DIGEST_POLL_INTERVAL)
+
+    def flush(self, force: bool) -> bool:
+        """
+        Send the digests that are due, and remove their spooled runs
+            :param force (bool):    Send all spooled runs regardless of the
+                                    window
+            :return (bool):         False if any digest could not be sent
+        """
+        due = self.get_due(force)
+        if not due:
+            return True
+        digests = []
+        for mode, spool_paths in due.items():
+            entries = []
+            for spool_path in spool_paths:
+                with open(spool_path, encoding="utf-8") as spool_file:
+                    entries.append(json.load(spool_file))
+            digests.append((self.get_message_obj(mode, entries), spool_paths))
+        return self.send_emails(digests)
+
+    def get_due(self, force: bool) -> dict:
+        """
+        Return the spooled runs per script mode that are due to be sent. A
+        mode is due once its oldest spooled run has waited for the window
+            :param force (bool):    Treat all spooled runs as due
+            :return due (dict):     Dictionary of script mode: list of spool
+                                    file paths, oldest first
+        """
+        due = {}
+        for mode in config.EMAIL_RECIPIENT:
+            spool_paths = sorted(
+                glob.glob(os.path.join(self.spool_dir, mode, "*.json")),
+                key=os.path.getmtime,
+            )
+            if spool_paths and (
+                force or time.time() - os.path.getmtime(spool_paths[0]) >= self.window
+            ):
+                due[mode] = spool_paths
+        return due
+
+    def get_message_obj(self, mode: str, entries: list) -> MIMEMultipart:
+        """
+        Create the combined message object for a script mode, rendering one
+        section per project from the email template and attaching the files
+        from all projects
+            :param mode (str):      Script mode ("TEST" or "PROD")
+            :param entries (list):  Spooled runs, oldest first
+            :return msg (object):   Message object for email
+        """
+        html = self.template.render(
+            projects=[entry["project"] for entry in entries],
+            git_tag=duty_csv.git_tag(),
+            script_mode=mode,
+        )
+        msg = MIMEMultipart()
+        # Both header types for maximum compatibility
+        msg["X-Priority"] = "1"
+        msg["X-MSMail-Priority"] = "High"
+        msg["Subject"] = config.DIGEST_SUBJECT[mode].format(len(entries))
+        msg["From"] = config.EMAIL_SENDER
+        msg["To"] = config.EMAIL_RECIPIENT[mode]
+        msg.attach(MIMEText(html, "html"))
+        for entry in entries:
+            for name, contents in entry["attachments"]:
+                attachment = MIMEApplication(contents)
+                attachment["Content-Disposition"] = f'attachment; filename="{name}"'
+                msg.attach(attachment)
+        logger.info(
+            f"Digest for {mode} mode created for {len(entries)} runs: "
+            f"{[entry['project']['project_name'] for entry in entries]}"
+        )
+        return msg
+
+    def send_emails(self, digests: list) -> bool:
+        """
+        Send digests over a single SMTP session. The spooled runs of each
+        digest are removed as soon as it has been sent, so a digest that
+        fails to send does not cause the digests already sent to be re-sent
+            :param digests (list):  List of (message object, spool file
+                                    paths) tuples
+            :return (bool):         True if all digests were sent
+        """
+        try:
+            server = smtplib.SMTP(host=config.HOST, port=config.PORT, timeout=10)
+            server.set_debuglevel(False)
+            server.starttls()  # Encrypt SMTP commands using TLS
+            server.ehlo()  # Identify client to ESMTP server using EHLO cmds
+            server.login(self.email_user, self.email_pw)
+        except Exception as exception:
+            logger.error(
+                "There was a problem connecting to the mail server to send the "
+                f"digest emails, with the following exception: {exception}",
+            )
+            return False
+        sent = 0
+        for msg, spool_paths in digests:
+            try:
+                server.sendmail(config.EMAIL_SENDER, msg["To"], msg.as_string())
+            except Exception as exception:
+                logger.error(
+                    f"There was a problem sending the digest email to {msg['To']}, "
+                    f"with the following exception: {exception}",
+                )
+                continue
+            logger.info(f"Digest has been emailed to {msg['To']}")
+            sent += 1
+            for spool_path in spool_paths:
+                os.remove(spool_path)
+        try:
+            server.quit()
+        except Exception as exception:
+            logger.warning(f"Could not close the mail server session: {exception}")
+        return sent == len(digests)
+
+
+def arg_parse() -> dict:
+    """
+    Parse arguments supplied by the command line. Create argument parser,
+    define command line arguments, then parse supplied command line arguments
+    using the created argument parser
+        :return (dict): Parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Send the emails spooled by duty_csv runs with the digest flag as "
+            "one combined email per script mode"
+        )
+    )
+    requirednamed = parser.add_argument_group("Required named arguments")
+    requirednamed.add_argument(
+        "-EU",
+        "--email_user",
+        type=str,
+        help="Username for mail server",
+        required=True,
+    )
+    requirednamed.add_argument(
+        "-PW",
+        "--email_pw",
+        type=str,
+        help="Password for mail server",
+        required=True,
+    )
+    parser.add_argument(
+        "--spool",
+        type=str,
+        help="Digest spool directory",
+        default=os.path.join(os.getcwd(), config.DIGEST_DIR),
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        help=(
+            "Seconds the oldest spooled run for a script mode waits before "
+            "the digest is sent"
+        ),
+        default=config.DIGEST_WINDOW,
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Send all spooled runs immediately and exit",
+        default=False,
+    )
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+
+    logger = Logger(os.path.join(os.getcwd(), config.DIGEST_LOGFILE)).logger
+    logger.info(f"Running duty_csv digest {duty_csv.git_tag()}")
+
+    DigestScheduler(
+        args["spool"], args["window"], args["email_user"], args["email_pw"]
+    ).run(args["once"])
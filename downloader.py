@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""downloader.py
+
+Download files from DNAnexus download URLs into the trust directory layout,
+using a pool of threads with resume of partial downloads and checksum
+verification against the DNAnexus file describe
+"""
+import os
+import time
+import numbers
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+import config
+
+# Configured by logger.Logger in the calling script
+logger = logging.getLogger("logger")
+
+
+class Downloader:
+    """
+    Download files from URLs into the GSTT_dir/subdir layout beneath a local
+    download directory. Files whose GSTT_dir contains placeholders populated
+    downstream are downloaded to a project staging directory instead. Each
+    thread keeps its own requests session so connections to each host are
+    reused between files. Partial downloads are resumed using HTTP range
+    requests, and completed files are verified against the MD5 checksums in
+    the DNAnexus file describe
+
+    Methods
+        download_all()
+            Download all rows using a pool of threads, and log throughput
+        download_file()
+            Download a single file, resuming any partial download, retrying
+            on failure
+        fetch()
+            Fetch the URL to the partial download file, resuming from the
+            end of any existing partial download
+        get_session()
+            Return the requests session for the current thread
+        get_size()
+            Return the file size from the row, if known
+        get_target_path()
+            Return the local file path that the file is downloaded to
+        verify()
+            Verify a downloaded file against its size and MD5 checksums
+    """
+
+    def __init__(
+        self,
+        download_dir: str,
+        project_name: str,
+        threads: int = config.DOWNLOAD_THREADS,
+        retries: int = config.DOWNLOAD_RETRIES,
+    ):
+        """
+        Constructor for the Downloader class
+            :param download_dir (str):  Local directory to download files into
+            :param project_name (str):  DNAnexus project name, used as the
+                                        staging directory for files whose
+                                        GSTT_dir contains placeholders
+            :param threads (int):       Number of files to download at once
+            :param retries (int):       Number of times to retry a failed
+                                        download
+        """
+        self.download_dir = download_dir
+        self.project_name = project_name
+        self.threads = threads
+        self.retries = retries
+        self.local = threading.local()
+
+    def download_all(self, rows: list) -> dict:
+        """
+        Download all rows using a pool of threads, and log throughput
+            :param rows (list):     List of dicts, each containing the Name,
+                                    Url, GSTT_dir, subdir, Size, MD5 and
+                                    Parts for a file
+            :return summary (dict): Dictionary of downloaded, failed and bytes
+                                    counts, elapsed seconds and throughput
+        """
+        summary = {"downloaded": 0, "failed": [], "bytes": 0}
+        # Rows with the same target path are only downloaded once
+        targets = {}
+        for row in rows:
+            try:
+                targets[self.get_target_path(row)] = row
+            except Exception as exception:
+                logger.error(
+                    f"Failed to find the target path for {row.get('Name')}, with "
+                    f"exception: {exception}"
+                )
+                summary["failed"].append(row.get("Name"))
+        logger.info(
+            f"Downloading {len(targets)} files to {self.download_dir} "
+            f"using {self.threads} threads"
+        )
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            futures = {
+                executor.submit(self.download_file, row, target): target
+                for target, row in targets.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    summary["bytes"] += future.result()
+                    summary["downloaded"] += 1
+                except Exception as exception:
+                    logger.error(
+                        f"Failed to download {futures[future]}, with exception: "
+                        f"{exception}"
+                    )
+                    summary["failed"].append(futures[future])
+        summary["seconds"] = time.monotonic() - start
+        summary["throughput"] = summary["bytes"] / max(summary["seconds"], 1e-6)
+        logger.info(
+            f"Downloaded {summary['downloaded']} files ({summary['bytes']} bytes) "
+            f"in {summary['seconds']:.1f} seconds, throughput "
+            f"{summary['throughput'] / 1024 / 1024:.2f} MB/s. "
+            f"{len(summary['failed'])} files failed"
+        )
+        return summary
+
+    def download_file(self, row: dict, target: str) -> int:
+        """
+        Download a single file, resuming any partial download, retrying on
+        failure. Files already present at the target path that pass
+        verification are not downloaded again
+            :param row (dict):      Row dictionary for the file
+            :param target (str):    Local file path to download to
+            :return (int):          Number of bytes transferred
+        """
+        if os.path.exists(target) and self.verify(target, row):
+            logger.info(f"File already downloaded and verified: {target}")
+            return 0
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        partial = f"{target}.part"
+        transferred = 0
+        for attempt in range(1, self.retries + 2):
+            try:
+                transferred += self.fetch(row["Url"], partial)
+                size = self.get_size(row)
+                if size is not None and os.path.getsize(partial) < size:
+                    # Keep the partial download so the next attempt resumes
+                    raise IOError("Connection closed before download completed")
+                if not self.verify(partial, row):
+                    # Corrupt download cannot be resumed, so start again
+                    os.remove(partial)
+                    raise ValueError("Checksum verification failed")
+                os.replace(partial, target)
+                logger.info(f"File downloaded and verified: {target}")
+                return transferred
+            except Exception as exception:
+                if attempt > self.retries:
+                    raise
+                logger.warning(
+                    f"Attempt {attempt} to download {target} failed, retrying. "
+                    f"Exception: {exception}"
+                )
+                time.sleep(config.DOWNLOAD_RETRY_DELAY * attempt)
+
+    def fetch(self, url: str, partial: str) -> int:
+        """
+        Fetch the URL to the partial download file, resuming from the end of
+        any existing partial download using a range request
+            :param url (str):       URL to download
+            :param partial (str):   Partial download file path
+            :return (int):          Number of bytes transferred
+        """
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.get_session().get(
+            url, headers=headers, stream=True, timeout=config.DOWNLOAD_TIMEOUT
+        ) as response:
+            if response.status_code == 416:
+                # Requested range not satisfiable - partial file is complete
+                return 0
+            response.raise_for_status()
+            # Append if the server honoured the range request, otherwise the
+            # full file has been returned so start from the beginning
+            mode = "ab" if response.status_code == 206 else "wb"
+            transferred = 0
+            with open(partial, mode) as partial_file:
+                for chunk in response.iter_content(config.DOWNLOAD_CHUNK_SIZE):
+                    partial_file.write(chunk)
+                    transferred += len(chunk)
+            return transferred
+
+    def get_session(self) -> requests.Session:
+        """
+        Return the requests session for the current thread, creating it if
+        required. The session's connection pool reuses connections per host
+            :return session (obj):  Requests session object
+        """
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    @staticmethod
+    def get_size(row: dict) -> int | None:
+        """
+        Return the file size from the row, if known
+            :param row (dict):      Row dictionary for the file
+            :return (int | None):   File size in bytes, or None if unknown
+        """
+        size = row.get("Size")
+        if isinstance(size, numbers.Real) and size == size:  # Exclude NaN
+            return int(size)
+
+    def get_target_path(self, row: dict) -> str:
+        """
+        Return the local file path that the file is downloaded to. The
+        GSTT_dir is mirrored beneath the download directory, with the drive
+        letter colon removed. GSTT_dirs containing path placeholders, which
+        are populated downstream, cannot be mirrored without files from
+        different runs sharing a directory, so these files are downloaded to
+        the project staging directory beneath the download directory, as in
+        the powershell download script. Files without a GSTT_dir (e.g. St
+        George's files for runtypes with no St George's path) are also
+        downloaded to the project staging directory
+            :param row (dict):      Row dictionary for the file
+            :return (str):          Local file path
+        """
+        subdir = row["subdir"] if isinstance(row["subdir"], str) else ""
+        if not isinstance(row["GSTT_dir"], str):
+            logger.warning(
+                f"File {row['Name']} has no GSTT_dir, so is downloaded to the "
+                "project staging directory"
+            )
+            target_dir = os.path.join(self.download_dir, self.project_name, subdir)
+        elif "%s" in row["GSTT_dir"] + subdir:
+            target_dir = os.path.join(self.download_dir, self.project_name, subdir)
+        else:
+            gstt_dir = row["GSTT_dir"].replace(":", "").lstrip("/\\")
+            target_dir = os.path.join(self.download_dir, gstt_dir, subdir)
+        return os.path.normpath(os.path.join(target_dir, row["Name"]))
+
+    def verify(self, path: str, row: dict) -> bool:
+        """
+        Verify a downloaded file against its size and MD5 checksums from the
+        DNAnexus describe. The whole-file MD5 is used where DNAnexus has one,
+        otherwise each upload part is checked against its part MD5
+            :param path (str):      Path of downloaded file
+            :param row (dict):      Row dictionary for the file
+            :return (bool):         True if the file passes verification
+        """
+        size = self.get_size(row)
+        if size is not None and os.path.getsize(path) != size:
+            return False
+        md5 = row.get("MD5")
+        parts = row.get("Parts")
+        with open(path, "rb") as downloaded_file:
+            if isinstance(md5, str):
+                hasher = hashlib.md5()
+                for chunk in iter(
+                    lambda: downloaded_file.read(config.DOWNLOAD_CHUNK_SIZE), b""
+                ):
+                    hasher.update(chunk)
+                return hasher.hexdigest() == md5
+            if isinstance(parts, dict):
+                for part_id in sorted(parts, key=int):
+                    data = downloaded_file.read(parts[part_id]["size"])
+                    if "md5" in parts[part_id] and (
+                        hashlib.md5(data).hexdigest() != parts[part_id]["md5"]
+                    ):
+                        return False
+                return downloaded_file.read(1) == b""
+        return True
@@ -6,18 +6,37 @@ run types that require file downloads, and save to a .csv file
 """
 import sys
 import os
+import re
+import copy
+import gzip
+import time
+import math
+import heapq
+import logging
 import smtplib
+import functools
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from email.mime.text import MIMEText
 import argparse
 import subprocess
 import json
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import requests
 import dxpy
 import jinja2
 import config
 from logger import Logger
+from downloader import Downloader
+from job_watcher import JobWatcher
+from profiler import StageProfiler
+from prefetch import PrefetchedSearch
+from deadline import Deadline
+from rate_limiter import RateLimiter
+
+# Configured by logger.Logger when the script or service is started
+logger = logging.getLogger("logger")
 
 
 class GenerateOutput:
@@ -39,6 +58,10 @@ class GenerateOutput:
         get_data_dicts()
             Search DNAnexus to find file data objects based on
             config-defined regexp patterns
+        check_pannumbers()
+            Report TSO500 pan numbers that matched no files
+        export_snapshot()
+            Export the job and data object listings to a snapshot file
         create_url_dataframe()
             Generate URL links from a list of data and
             produce a pandas dataframe
@@ -56,21 +79,49 @@ class GenerateOutput:
             Create a url for a file in DNAnexus
         create_csv()
             Write dataframe to CSV, and return CSV format as string
+        create_url_manifest()
+            Write the file ID and expiry time of each URL to a JSON manifest
+        get_download_dataframe()
+            Return the rows of the urls dataframe that have URLs
+        create_csv_shards()
+            Split the dataframe into size-balanced shards, write each shard
+            to its own CSV, and return list of (file name, CSV string) tuples
+        get_shard_indices()
+            Bin-pack dataframe rows into shards balanced by total bytes
         create_chrome_download_cmds()
             Creates a text file containing downloads that can be run to download the files via chrome,
             to be used in case the powershell script does not work over citrix / VPN
+        create_powershell_download_script()
+            Creates a powershell script that downloads the files in parallel
+            batches directly into their GSTT_dir + subdir target directories
         get_filetype_html()
             Generate HTML for files by filetype
+        get_sample_matrix()
+            Count the files per sample and file type
         get_number_of_files()
             Calculate number of files to download for project
+        get_email_context()
+            Return the project-specific variables for the email template
         generate_email_html()
-            Generate HTML
+            Generate HTML, streaming it to file
+        get_attachments()
+            Return list of (file name, contents) tuples to attach to the email
         get_message_obj()
             Create message object
         send_email()
-            Use smtplib to send an email
+            Use smtplib to send an email, or spool it for the digest email
+        spool_email()
+            Write the email contents to the digest spool directory
+        download_files()
+            Download the files in the urls dataframe into the GSTT_dir/subdir
+            layout beneath the download directory
+        check_complete()
+            Exit with the config-defined exit code if the deadline was
+            exceeded
     """
 
+    OUTPUT_SUFFIX = "duty_csv"  # Suffix of the output file names
+
     def __init__(
         self,
         project_name: str,
@@ -80,6 +131,14 @@ class GenerateOutput:
         stg_pannumbers: list,
         cp_capture_pannos: list,
         mode: str,
+        shards: int = 1,
+        download_dir: str | None = None,
+        runtype_downloads: dict = config.PER_RUNTYPE_DOWNLOADS,
+        profile: bool = False,
+        tso_pannumbers: list | None = None,
+        snapshot: bool = False,
+        digest: bool = False,
+        deadline: int | None = config.RUN_DEADLINE,
     ):
         """
         Constructor for the GenerateOutput class
@@ -91,47 +150,93 @@ class GenerateOutput:
             :param cp_capture_pannos (list):    Custom panels whole capture
                                                 pan numbers
             :mode (str):                        Script mode ("TEST" or "PROD")
+            :param shards (int):                Minimum number of CSV shards
+                                                to split the download list
+                                                into (1 disables sharding)
+            :param download_dir (str | None):   Directory to download the
+                                                files into, or None to not
+                                                download files
+            :param runtype_downloads (dict):    Files requiring download per
+                                                runtype, with the TSO500 regex
+                                                populated with pan numbers
+            :param profile (bool):              Write cProfile stats and
+                                                tracemalloc top allocations
+                                                for each stage
+            :param tso_pannumbers (list | None):    Synnovis TSO500 pan
+                                                    numbers used to populate
+                                                    the TSO500 regex
+            :param snapshot (bool):             Export the job and data object
+                                                listings to a snapshot file
+            :param digest (bool):               Spool the email contents to be
+                                                sent in a combined digest
+                                                email, instead of sending the
+                                                email
+            :param deadline (int | None):       Deadline for the whole run in
+                                                seconds, or None for no
+                                                deadline
         """
         self.email_user = email_user
         self.email_pw = email_pw
         self.stg_pannumbers = stg_pannumbers
+        self.tso_pannumbers = tso_pannumbers
+        self.snapshot = snapshot
+        self.digest = digest
         self.cp_capture_pannos = cp_capture_pannos
         self.script_mode = mode
+        self.shards = shards
+        self.download_dir = download_dir
         self.project_name = project_name
         self.project_id = project_id
-        self.runtype = self.get_runtype()
-        self.email_recipient = config.EMAIL_RECIPIENT[self.script_mode]
-        self.project_jobs = self.get_jobs()
-        self.csvfile_name = (
-            f"{self.project_name}.{self.project_id}.{self.runtype}.duty_csv.csv"
-        )
-        self.htmlfile_name = (
-            f"{self.project_name}.{self.project_id}.{self.runtype}.duty_csv.html"
+        self.deadline = Deadline(deadline)
+        self.missing_files = []  # Files whose URLs were not created in time
+        self.url_calls = None  # URL creation started while searching
+        self.incomplete = []  # Searches that did not finish in time
+        self.profiler = StageProfiler(
+            os.path.join(os.getcwd(), f"{self.project_name}.{self.project_id}"),
+            profile,
         )
-        self.txtfile_name = (
-            f"{self.project_name}.{self.project_id}.{self.runtype}.duty_csv.txt"
+        self.runtype = self.profiler.run(self.get_runtype)
+        self.email_recipient = config.EMAIL_RECIPIENT[self.script_mode]
+        self.project_jobs = self.profiler.run(self.get_jobs)
+        output_prefix = (
+            f"{self.project_name}.{self.project_id}.{self.runtype}.{self.OUTPUT_SUFFIX}"
         )
+        self.csvfile_name = f"{output_prefix}.csv"
+        self.htmlfile_name = f"{output_prefix}.html"
+        self.txtfile_name = f"{output_prefix}.txt"
         self.csvfile_path = os.path.join(os.getcwd(), self.csvfile_name)
         self.htmlfile_path = os.path.join(os.getcwd(), self.htmlfile_name)
         self.txtfile_path = os.path.join(os.getcwd(), self.txtfile_name)
-        self.template = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(config.TEMPLATE_DIR),
-            autoescape=True,
-        ).get_template(config.EMAIL_TEMPLATE)
+        self.ps1file_name = f"{output_prefix}.ps1"
+        self.ps1file_path = os.path.join(os.getcwd(), self.ps1file_name)
+        self.manifest_path = os.path.join(os.getcwd(), f"{output_prefix}.urls.json")
+        self.snapshot_path = os.path.join(
+            os.getcwd(),
+            f"{self.project_name}.{self.project_id}.duty_csv.snapshot.jsonl.gz",
+        )
+        self.template = get_template(config.EMAIL_TEMPLATE, autoescape=True)
+        self.ps1_template = get_template(config.POWERSHELL_TEMPLATE, autoescape=False)
 
         self.email_subject = config.EMAIL_SUBJECT[self.script_mode].format(
             self.runtype, self.project_name
         )
-        self.file_dict = config.PER_RUNTYPE_DOWNLOADS[self.runtype]
-        self.data_obj_dict, self.data_num_dict = self.get_data_dicts()
-        self.url_dataframe = self.create_url_dataframe()
-        self.csv_contents = self.create_csv()
-        self.txt_contents = self.create_chrome_download_cmds()
-        self.filetype_html = self.get_filetype_html()
-        self.number_of_files = self.get_number_of_files()
-        self.html = self.generate_email_html()
-        self.email_msg = self.get_message_obj()
-        self.send_email()
+        self.file_dict = runtype_downloads[self.runtype]
+        self.data_obj_dict, self.data_num_dict = self.profiler.run(self.get_data_dicts)
+        self.profiler.run(self.export_snapshot)
+        self.url_dataframe = self.profiler.run(self.create_url_dataframe)
+        self.csv_contents = self.profiler.run(self.create_csv)
+        self.profiler.run(self.create_url_manifest)
+        self.shard_files = self.profiler.run(self.create_csv_shards)
+        self.txt_contents = self.profiler.run(self.create_chrome_download_cmds)
+        self.ps1_contents = self.profiler.run(self.create_powershell_download_script)
+        self.filetype_html = self.profiler.run(self.get_filetype_html)
+        self.sample_matrix = self.profiler.run(self.get_sample_matrix)
+        self.number_of_files = self.profiler.run(self.get_number_of_files)
+        self.profiler.run(self.generate_email_html)
+        self.email_msg = self.profiler.run(self.get_message_obj)
+        self.profiler.run(self.send_email)
+        self.profiler.run(self.download_files)
+        self.profiler.run(self.check_complete)
         logger.info("Script completed")
 
     def get_runtype(self) -> str | None:
@@ -165,15 +270,25 @@ class GenerateOutput:
             :return project_jobs (list): List of job ID strings within project
         """
         try:
-            project_jobs = list(
-                dxpy.bindings.search.find_executions(
-                    project=self.project_id, describe=True
-                )
-            )
+            project_jobs = []
             states = []
-            for job in project_jobs:
-                state = job.get("describe").get("state")
-                states.append(state)
+            try:
+                for job in PrefetchedSearch(
+                    dxpy.bindings.search.find_executions,
+                    time_limit=self.deadline.remaining("get_jobs"),
+                    wrap=self.profiler.wrap,
+                    project=self.project_id,
+                    describe=True,
+                ):
+                    project_jobs.append(job)
+                    state = job.get("describe").get("state")
+                    states.append(state)
+            except TimeoutError:
+                logger.warning(
+                    "The deadline was exceeded when identifying jobs in the "
+                    "DNAnexus project. The number of jobs is incomplete"
+                )
+                self.incomplete.append("Job search")
             logger.info(
                 f"{len(project_jobs)} jobs were identified in the DNAnexus project"
             )
@@ -188,7 +303,12 @@ class GenerateOutput:
         """
         Search DNAnexus to find file data objects based on
         config-defined regexp patterns. N.B. find_data_objects finds files
-        both at the defined folder level and within any subdirectories
+        both at the defined folder level and within any subdirectories. The
+        searches for all file types are started at once, so that they run
+        concurrently, and the URL for each data object is created on a worker
+        thread as soon as it is found, so URL creation overlaps with the
+        searches. If the deadline is exceeded, the data objects found so far
+        are used
             :return data_obj_dict(dict) | None: Dictionary of data objects for
                                                 use in downloading files
             :return data_num_dict(dict) | None: Dictionary of number of data
@@ -204,16 +324,42 @@ class GenerateOutput:
                 "Searching for data objects in DNAnexus project "
                 "using regular expressions"
             )
-            for filetype in self.file_dict:
-                data_obj_dict[filetype] = list(
-                    dxpy.bindings.search.find_data_objects(
-                        project=self.project_id,
-                        name=self.file_dict[filetype]["regex"],
-                        name_mode="regexp",
-                        describe=True,
-                        folder=self.file_dict[filetype]["folder"],
-                    )
+            time_limit = self.deadline.remaining("get_data_dicts")
+            self.url_calls = self.deadline.start_calls(
+                self.profiler.wrap(self.get_url), config.URL_THREADS
+            )
+            searches = {
+                filetype: PrefetchedSearch(
+                    dxpy.bindings.search.find_data_objects,
+                    time_limit=time_limit,
+                    wrap=self.profiler.wrap,
+                    project=self.project_id,
+                    name=self.file_dict[filetype]["regex"],
+                    name_mode="regexp",
+                    describe=config.DATA_OBJ_DESCRIBE,
+                    folder=self.file_dict[filetype]["folder"],
                 )
+                for filetype in self.file_dict
+            }
+            for filetype, search in searches.items():
+                data_obj_dict[filetype] = []
+                try:
+                    for data_obj in search:
+                        data_obj_dict[filetype].append(data_obj)
+                        self.url_calls.submit(
+                            data_obj.get("id"),
+                            (
+                                data_obj.get("id"),
+                                self.project_id,
+                                data_obj.get("describe").get("name"),
+                            ),
+                        )
+                except TimeoutError:
+                    logger.warning(
+                        "The deadline was exceeded when searching for "
+                        f"{filetype} files. The {filetype} files are incomplete"
+                    )
+                    self.incomplete.append(f"{filetype} file search")
                 try:
                     data_num = len(data_obj_dict[filetype])
                     logger.info(f"The number of items for {filetype} is {data_num}")
@@ -224,6 +370,7 @@ class GenerateOutput:
                         f"the following file type: {exception}"
                     )
                     sys.exit(1)
+            self.check_pannumbers(data_obj_dict)
             return data_obj_dict, data_num_dict
         else:
             logger.info(
@@ -232,6 +379,68 @@ class GenerateOutput:
             )
             return None, None
 
+    def check_pannumbers(self, data_obj_dict: dict) -> None:
+        """
+        Report TSO500 pan numbers that matched no files. File names are
+        matched locally against the same trie-shaped pattern used for the
+        DNAnexus search, capturing the pan number each file matched
+            :param data_obj_dict (dict):    Dictionary of data objects per
+                                            file type
+        """
+        if self.runtype == "TSO500" and self.tso_pannumbers:
+            pan_regex = build_alternation_regex(self.tso_pannumbers)
+            pan_pattern = re.compile(f"({pan_regex})")
+            for filetype in config.TSO_PAN_FILETYPES:
+                matched = set()
+                for data_obj in data_obj_dict.get(filetype, []):
+                    match = pan_pattern.search(data_obj.get("describe").get("name"))
+                    if match:
+                        matched.add(match.group(1))
+                unmatched = sorted(set(self.tso_pannumbers) - matched)
+                if unmatched:
+                    logger.warning(
+                        f"The following pan numbers matched no {filetype} files: "
+                        f"{unmatched}"
+                    )
+                else:
+                    logger.info(f"All pan numbers matched {filetype} files")
+
+    def export_snapshot(self) -> None:
+        """
+        Export the job and data object listings fetched from DNAnexus to a
+        gzipped JSONL snapshot file, if requested. The first line is a header
+        describing the run, followed by one line per job and per data object
+        """
+        if self.snapshot:
+            try:
+                with gzip.open(self.snapshot_path, "wt", encoding="utf-8") as snapshot:
+                    header = {
+                        "type": "header",
+                        "project_name": self.project_name,
+                        "project_id": self.project_id,
+                        "created": time.time(),
+                        "git_tag": git_tag(),
+                    }
+                    snapshot.write(f"{json.dumps(header)}\n")
+                    for job in self.project_jobs:
+                        snapshot.write(f"{json.dumps({'type': 'job', 'data': job})}\n")
+                    for filetype, data_objs in (self.data_obj_dict or {}).items():
+                        for data_obj in data_objs:
+                            line = {
+                                "type": "data_object",
+                                "filetype": filetype,
+                                "data": data_obj,
+                            }
+                            snapshot.write(f"{json.dumps(line)}\n")
+                logger.info(f"Snapshot has been exported: {self.snapshot_path}")
+            except Exception as exception:
+                logger.error(
+                    f"An error was encountered when exporting the snapshot: {exception}"
+                )
+                sys.exit(1)
+        else:
+            logger.info("No snapshot was exported as this was not requested")
+
     def create_url_dataframe(self) -> pd.core.frame.DataFrame | None:
         """
         Generate URL links from a list of data and produce a pandas dataframe
@@ -249,7 +458,7 @@ class GenerateOutput:
                 dataframe = (
                     pd.DataFrame(
                         self.get_url_attrs(),
-                        columns=config.COLS,
+                        columns=config.COLS + config.INTERNAL_COLS,
                     )
                     .explode("GSTT_dir")
                     .sort_values(
@@ -278,24 +487,76 @@ class GenerateOutput:
     def get_url_attrs(self) -> list:
         """
         Return list of lists, each list containing the items that populate the
-        rows of the CSV file
+        rows of the CSV file. URLs are created in parallel, continuing the URL
+        creation started while searching if there was any, and files whose
+        URLs were not created before the deadline are given the config-defined
+        placeholder URL, with an expiry time of 0 so that the refresh mode
+        creates their URLs
             :return attrs_list (list): List of lists, each
         """
         try:
+            data_objs = [
+                (filetype, data_obj)
+                for filetype in self.data_obj_dict
+                for data_obj in self.data_obj_dict[filetype]
+            ]
+            url_calls = self.url_calls or self.deadline.start_calls(
+                self.profiler.wrap(self.get_url), config.URL_THREADS
+            )
+            self.url_calls = None
+            for _, data_obj in data_objs:
+                # Files already submitted while searching are not resubmitted
+                url_calls.submit(
+                    data_obj.get("id"),
+                    (
+                        data_obj.get("id"),
+                        self.project_id,
+                        data_obj.get("describe").get("name"),
+                    ),
+                )
+            urls = url_calls.wait("create_url_dataframe")
             attrs_list = []
-            for filetype in self.data_obj_dict:
+            for filetype, data_obj in data_objs:
                 subdir = config.GSTT_PATHS[self.script_mode][self.runtype][filetype][
                     "subdir"
                 ]
-                for data_obj in self.data_obj_dict[filetype]:
-                    file_name = data_obj.get("describe").get("name")
-                    folder = data_obj.get("describe").get("folder")
-                    file_id = data_obj.get("id")
-                    url = self.get_url(file_id, self.project_id, file_name)
+                file_name = data_obj.get("describe").get("name")
+                folder = data_obj.get("describe").get("folder")
+                size = data_obj.get("describe").get("size")
+                md5 = data_obj.get("describe").get("md5")
+                parts = data_obj.get("describe").get("parts")
+                file_id = data_obj.get("id")
+                if file_id in urls:
+                    url = urls[file_id]
+                    expires = time.time() + config.URL_DURATION
                     trust_dirs = self.get_trust_dirs(filetype, url)
-                    attrs_list.append(
-                        [file_name, folder, filetype, url, trust_dirs, subdir]
+                else:
+                    url = config.DEADLINE_MISSING_URL.format(file_id=file_id)
+                    expires = 0
+                    trust_dirs = self.get_trust_dirs(filetype, file_name)
+                    self.missing_files.append(
+                        {"Name": file_name, "Folder": folder, "Url": url}
                     )
+                attrs_list.append(
+                    [
+                        file_name,
+                        folder,
+                        filetype,
+                        url,
+                        trust_dirs,
+                        subdir,
+                        size,
+                        md5,
+                        parts,
+                        file_id,
+                        expires,
+                    ]
+                )
+            if self.missing_files:
+                logger.warning(
+                    "The deadline was exceeded when creating URLs. URLs were not "
+                    f"created for {len(self.missing_files)} files"
+                )
             return attrs_list
         except Exception as exception:
             logger.error(
@@ -350,7 +611,7 @@ class GenerateOutput:
         dxfile = dxpy.DXFile(file_id)
         try:
             url = dxfile.get_download_url(
-                duration=60 * 60 * 24 * 5,  # 60 sec x 60 min x 24 hours * 5 days
+                duration=config.URL_DURATION,
                 preauthenticated=True,
                 project=project_id,
                 filename=file_name,
@@ -374,9 +635,13 @@ class GenerateOutput:
             )
             try:
                 # Write to file
-                self.url_dataframe.to_csv(self.csvfile_path, index=False)
+                self.url_dataframe.to_csv(
+                    self.csvfile_path, index=False, columns=config.COLS
+                )
                 # Save as variable
-                csv_contents = self.url_dataframe.to_csv(index=False)
+                csv_contents = self.url_dataframe.to_csv(
+                    index=False, columns=config.COLS
+                )
                 logger.info(f"CSV file has been created: {self.csvfile_path}")
                 return csv_contents
 
@@ -389,6 +654,194 @@ class GenerateOutput:
         else:
             logger.info("No CSV file was created as no URL dataframe exists")
 
+    def create_url_manifest(self) -> None:
+        """
+        Write the file ID, expiry time and file size of each URL to a JSON
+        manifest alongside the CSV file, along with the project's job IDs, so
+        that expired URLs can later be refreshed without repeating the job
+        listing or data object search. Unknown values are written as null
+        """
+        if self.url_dataframe is not None:
+            try:
+                manifest = {
+                    "project_id": self.project_id,
+                    "jobs": [job.get("id") for job in self.project_jobs],
+                    "urls": {
+                        row["Url"]: {
+                            key: None if pd.isna(row[column]) else row[column]
+                            for key, column in (
+                                ("file_id", "File_ID"),
+                                ("expires", "Expires"),
+                                ("size", "Size"),
+                            )
+                        }
+                        for row in self.url_dataframe.to_dict("records")
+                    },
+                }
+                with open(self.manifest_path, "w", encoding="utf-8") as manifest_file:
+                    json.dump(manifest, manifest_file)
+                logger.info(f"URL manifest has been created: {self.manifest_path}")
+            except Exception as exception:
+                logger.error(
+                    f"An error was encountered when writing the URL manifest: {exception}"
+                )
+                sys.exit(1)
+        else:
+            logger.info("No URL manifest was created as no URL dataframe exists")
+
+    def get_download_dataframe(self) -> pd.core.frame.DataFrame:
+        """
+        Return the rows of the urls dataframe that have URLs, excluding files
+        whose URLs were not created before the deadline
+            :return (tabular):  Pandas dataframe of rows with URLs
+        """
+        missing_urls = [missing_file["Url"] for missing_file in self.missing_files]
+        return self.url_dataframe[~self.url_dataframe["Url"].isin(missing_urls)]
+
+    def create_csv_shards(self) -> list | None:
+        """
+        Split the dataframe into shards balanced by total bytes, write each
+        shard to its own CSV, and return the shards so they can be attached
+        to the email. Shards can then be processed by parallel downloaders
+            :return shard_files (list) | None:  List of (file name, CSV
+                                                string) tuples, or None if
+                                                sharding is not required
+        """
+        if self.url_dataframe is not None and self.shards > 1:
+            logger.info(
+                f"Creating csv shards for {self.runtype} project: {self.project_name}"
+            )
+            try:
+                shard_indices = self.get_shard_indices()
+                shard_files = []
+                for number, indices in enumerate(shard_indices, start=1):
+                    shard_name = self.csvfile_name.replace(
+                        ".duty_csv.csv",
+                        f".shard{number}of{len(shard_indices)}.duty_csv.csv",
+                    )
+                    shard_dataframe = self.url_dataframe.loc[sorted(indices)]
+                    shard_dataframe.to_csv(
+                        os.path.join(os.getcwd(), shard_name),
+                        index=False,
+                        columns=config.COLS,
+                    )
+                    shard_files.append(
+                        (
+                            shard_name,
+                            shard_dataframe.to_csv(index=False, columns=config.COLS),
+                        )
+                    )
+                    logger.info(
+                        f"CSV shard has been created: {shard_name} "
+                        f"({len(indices)} rows)"
+                    )
+                return shard_files
+
+            except Exception as exception:
+                logger.error(
+                    "An error was encountered when writing the urls "
+                    f"dataframe to CSV shards: {exception}",
+                )
+                sys.exit(1)
+        else:
+            logger.info("No CSV shards were created as sharding is not required")
+
+    def get_shard_indices(self) -> list:
+        """
+        Bin-pack dataframe rows into shards balanced by total bytes. Rows for
+        the same destination directory are kept together unless this would
+        leave the shards unbalanced by more than the config-defined tolerance.
+        The number of shards is increased above the requested number if
+        required so that each shard can be downloaded within the
+        config-defined fraction of the URL lifetime at the config-defined
+        bandwidth. If the file sizes are not known (e.g. when refreshing a CSV
+        without a URL manifest), shards are balanced by number of files
+            :return shard_indices (list):   List of lists of dataframe indices
+        """
+        if self.url_dataframe.get("Size", pd.Series(dtype=float)).notna().any():
+            sizes = self.url_dataframe["Size"].fillna(0)
+            unit = "bytes"
+            max_shard_bytes = (
+                config.DOWNLOAD_BANDWIDTH
+                * config.URL_DURATION
+                * config.SHARD_EXPIRY_FRACTION
+            )
+        else:
+            logger.warning(
+                "File sizes are not known, so shards are balanced by number of files"
+            )
+            sizes = pd.Series(1, index=self.url_dataframe.index)
+            unit = "files"
+            max_shard_bytes = math.inf
+        total_bytes = sizes.sum()
+        shard_count = max(self.shards, math.ceil(total_bytes / max_shard_bytes))
+        chunk_limit = min(max_shard_bytes, total_bytes / shard_count)
+        groups = self.url_dataframe.groupby(
+            ["GSTT_dir", "subdir"], dropna=False, sort=False
+        ).groups
+        # Once the chunk limit is below the smallest non-zero size, every
+        # non-zero row is in a chunk of its own, so halving it again cannot
+        # change the chunks (zero byte rows are never split from each other)
+        min_row_bytes = sizes[sizes > 0].min() if (sizes > 0).any() else 0
+
+        while True:
+            # Split destination directory groups into chunks no bigger than
+            # the chunk limit
+            chunks = []
+            for group_indices in groups.values():
+                chunk, chunk_bytes = [], 0
+                for index in group_indices:
+                    if chunk and chunk_bytes + sizes[index] > chunk_limit:
+                        chunks.append((chunk_bytes, chunk))
+                        chunk, chunk_bytes = [], 0
+                    chunk.append(index)
+                    chunk_bytes += sizes[index]
+                chunks.append((chunk_bytes, chunk))
+
+            # Longest processing time first - assign each chunk, largest
+            # first, to the currently least loaded shard
+            heap = [(0, number) for number in range(shard_count)]
+            shard_indices = [[] for _ in range(shard_count)]
+            for chunk_bytes, chunk in sorted(
+                chunks, key=lambda item: item[0], reverse=True
+            ):
+                shard_bytes, number = heapq.heappop(heap)
+                heapq.heappush(heap, (shard_bytes + chunk_bytes, number))
+                shard_indices[number].extend(chunk)
+            shard_bytes = {number: load for load, number in heap}
+
+            largest_shard_bytes = max(shard_bytes.values())
+            balance_limit = (
+                total_bytes / shard_count * (1 + config.SHARD_BALANCE_TOLERANCE)
+            )
+            if largest_shard_bytes > max_shard_bytes and shard_count < len(sizes):
+                shard_count += 1
+                chunk_limit = min(chunk_limit, total_bytes / shard_count)
+            elif (
+                largest_shard_bytes > balance_limit
+                and len(chunks) < len(sizes)
+                and chunk_limit >= min_row_bytes
+            ):
+                # Break destination groups into smaller chunks to balance
+                chunk_limit /= 2
+            else:
+                break
+
+        for number, indices in enumerate(shard_indices):
+            if indices:
+                message = (
+                    f"Shard {number + 1} contains {len(indices)} rows totalling "
+                    f"{int(shard_bytes[number])} {unit}"
+                )
+                if unit == "bytes":
+                    message += (
+                        ", estimated download time "
+                        f"{int(shard_bytes[number] / config.DOWNLOAD_BANDWIDTH)} "
+                        "seconds"
+                    )
+                logger.info(message)
+        return [indices for indices in shard_indices if indices]
+
     def create_chrome_download_cmds(self) -> str | None:
         """
         Creates a text file containing commands that can be run to download the files via chrome,
@@ -400,7 +853,7 @@ class GenerateOutput:
                 f"Creating chrome download commands file for {self.runtype} project: {self.project_name}"
             )
             try:
-                urls = "start chrome " + self.url_dataframe["Url"]
+                urls = "start chrome " + self.get_download_dataframe()["Url"]
                 urls.drop_duplicates(inplace=True)
                 # Write to file
                 urls.to_csv(self.txtfile_path, index=False)
@@ -419,6 +872,76 @@ class GenerateOutput:
                 "No chrome download command file was created as no URL dataframe exists"
             )
 
+    def create_powershell_download_script(self) -> str | None:
+        """
+        Creates a powershell script that downloads the files in parallel
+        batches with a bounded number of jobs, placing each file directly in
+        its GSTT_dir + subdir target directory and retrying failed downloads.
+        Target directories containing placeholders populated downstream by
+        process_duty_csv are left blank, so the script downloads these files
+        to its staging directory. Files without a target directory (e.g. St
+        George's files for runtypes with no St George's path) are also
+        downloaded to the staging directory
+            :return ps1_contents (str): Return resulting PS1 format as string
+        """
+        if self.url_dataframe is not None:
+            logger.info(
+                "Creating powershell download script for "
+                f"{self.runtype} project: {self.project_name}"
+            )
+            try:
+                rows, seen, no_target_dir = [], set(), set()
+                for row in self.get_download_dataframe().to_dict("records"):
+                    subdir = row["subdir"] if isinstance(row["subdir"], str) else ""
+                    if not isinstance(row["GSTT_dir"], str):
+                        no_target_dir.add(row["Name"])
+                        target_dir = ""
+                    else:
+                        target_dir = row["GSTT_dir"] + subdir
+                    if "%s" in target_dir:
+                        target_dir = ""
+                    ps1_row = {
+                        # Powershell single quoted strings escape ' as ''
+                        key: str(value).replace("'", "''")
+                        for key, value in (
+                            ("Url", row["Url"]),
+                            ("Dir", target_dir),
+                            ("Subdir", subdir),
+                            ("Name", row["Name"]),
+                        )
+                    }
+                    if tuple(ps1_row.values()) not in seen:
+                        seen.add(tuple(ps1_row.values()))
+                        rows.append(ps1_row)
+                if no_target_dir:
+                    logger.warning(
+                        f"{len(no_target_dir)} files have no target directory and "
+                        "will be downloaded to the powershell script staging "
+                        f"directory: {', '.join(sorted(no_target_dir))}"
+                    )
+                ps1_contents = self.ps1_template.render(
+                    rows=rows,
+                    project_name=self.project_name,
+                    max_jobs=config.POWERSHELL_MAX_JOBS,
+                    retries=config.POWERSHELL_RETRIES,
+                    git_tag=git_tag(),
+                )
+                with open(self.ps1file_path, "w", encoding="utf-8") as ps1file:
+                    ps1file.write(ps1_contents)
+                logger.info(f"PS1 file has been created: {self.ps1file_path}")
+                return ps1_contents
+
+            except Exception as exception:
+                logger.error(
+                    "An error was encountered when writing the powershell "
+                    f"download script: {exception}"
+                )
+                sys.exit(1)
+        else:
+            logger.info(
+                "No powershell download script was created as no URL dataframe exists"
+            )
+
     def get_filetype_html(self) -> str:
         """
         Generate HTML for files by filetype
@@ -444,6 +967,59 @@ class GenerateOutput:
                 "there are no DNAnexus data objects marked for download"
             )
 
+    def get_sample_matrix(self) -> dict | None:
+        """
+        Count the files per sample and file type in a single grouping pass
+        over the urls dataframe, so that the email shows which samples are
+        missing files. Sample names are taken from the file names using the
+        config-defined pattern, and files without a sample name are counted
+        as run-level files. File types are flagged as per-sample if any of
+        their files has a sample name, so that run-level file types are not
+        flagged as missing for every sample
+            :return sample_matrix (dict) | None:    Dictionary of file types,
+                                                    whether each file type is
+                                                    per-sample, and the
+                                                    counts per sample, or None
+                                                    if no URL dataframe exists
+        """
+        if self.url_dataframe is not None:
+            try:
+                files = self.url_dataframe.drop_duplicates(["Name", "Folder", "Type"])
+                samples = (
+                    files["Name"]
+                    .str.extract(config.SAMPLE_PATTERN, expand=False)
+                    .fillna(config.RUN_LEVEL_SAMPLE)
+                )
+                filetypes = list(self.data_num_dict)
+                counts = (
+                    files.groupby([samples.rename("Sample"), files["Type"]])
+                    .size()
+                    .unstack(fill_value=0)
+                    .reindex(columns=filetypes, fill_value=0)
+                )
+                run_level = counts.index == config.RUN_LEVEL_SAMPLE
+                per_sample = counts[~run_level].sum().astype(bool).tolist()
+                # Samples in name order, followed by run-level files
+                counts = pd.concat([counts[~run_level], counts[run_level]])
+                sample_matrix = {
+                    "filetypes": filetypes,
+                    "per_sample": per_sample,
+                    "rows": [
+                        {"sample": sample, "counts": row}
+                        for sample, row in zip(counts.index, counts.values.tolist())
+                    ],
+                    "run_level": config.RUN_LEVEL_SAMPLE,
+                }
+                logger.info(f"Sample matrix generated for {(~run_level).sum()} samples")
+                return sample_matrix
+            except Exception as exception:
+                logger.error(
+                    f"There was an exception when generating the sample matrix: {exception}"
+                )
+                sys.exit(1)
+        else:
+            logger.info("Sample matrix was not generated as no URL dataframe exists")
+
     def get_number_of_files(self) -> int | None:
         """
         Calculate number of files to download for project
@@ -469,26 +1045,44 @@ class GenerateOutput:
                 "objects marked for download"
             )
 
-    def generate_email_html(self) -> str:
+    def get_email_context(self) -> dict:
+        """
+        Return the project-specific variables for the email template. The
+        template renders one section per project, so that digest emails can
+        be rendered from the same template
+            :return (dict): Project-specific template variables
+        """
+        return {
+            "runtype": self.runtype,
+            "num_jobs": len(self.project_jobs),
+            "project_name": self.project_name,
+            "number_of_files": self.number_of_files,
+            "files_by_filetype": self.filetype_html,
+            "sample_matrix": self.sample_matrix,
+            "incomplete": self.incomplete,
+            "missing_files": [
+                f"{missing_file['Folder']}/{missing_file['Name']}"
+                for missing_file in self.missing_files
+            ],
+        }
+
+    def generate_email_html(self) -> None:
         """
-        Generate HTML
-            :return html (str): Rendered html as a string
+        Generate HTML, streaming the rendered template to file as it is
+        generated, so that the sample matrix for large runs is never held in
+        memory as one string during rendering
         """
         try:
-            html = self.template.render(
-                runtype=self.runtype,
-                num_jobs=len(self.project_jobs),
-                project_name=self.project_name,
-                number_of_files=self.number_of_files,
-                files_by_filetype=self.filetype_html,
-                git_tag=git_tag(),
-                script_mode=self.script_mode,
-            )
-            logger.info("Successfully generated email HTML")
             with open(self.htmlfile_path, "w+", encoding="utf-8") as htmlfile:
-                htmlfile.write(html)
+                htmlfile.writelines(
+                    self.template.generate(
+                        projects=[self.get_email_context()],
+                        git_tag=git_tag(),
+                        script_mode=self.script_mode,
+                    )
+                )
+            logger.info("Successfully generated email HTML")
             logger.info("HTML successfully written to file")
-            return html
         except Exception as exception:
             logger.error(
                 "There was a problem generating the html file, with "
@@ -496,6 +1090,18 @@ class GenerateOutput:
             )
             sys.exit(1)
 
+    def get_attachments(self) -> list:
+        """
+        Return the files to attach to the email
+            :return (list): List of (file name, contents) tuples
+        """
+        return [
+            (self.csvfile_name, self.csv_contents),
+            (self.txtfile_name, self.txt_contents),
+            (self.ps1file_name, self.ps1_contents),
+            *(self.shard_files or []),
+        ]
+
     def get_message_obj(self) -> MIMEMultipart | None:
         """
         Create message object
@@ -508,10 +1114,11 @@ class GenerateOutput:
         msg["Subject"] = self.email_subject
         msg["From"] = config.EMAIL_SENDER
         msg["To"] = self.email_recipient
-        msg.attach(MIMEText(self.html, "html"))
+        with open(self.htmlfile_path, encoding="utf-8") as htmlfile:
+            msg.attach(MIMEText(htmlfile.read(), "html"))
         logger.info("HTML email message attached")
-        msg = self.attach_file(self.csv_contents, self.csvfile_name, msg)
-        msg = self.attach_file(self.txt_contents, self.txtfile_name, msg)
+        for name, contents in self.get_attachments():
+            msg = self.attach_file(contents, name, msg)
         return msg
 
     def attach_file(self, contents, name, msg) -> None:
@@ -535,8 +1142,12 @@ class GenerateOutput:
 
     def send_email(self) -> None:
         """
-        Use smtplib to send an email
+        Use smtplib to send an email, or spool the email contents to be sent
+        in a combined digest email if requested
         """
+        if self.digest:
+            self.spool_email()
+            return
         try:
             # Configure SMTP server connection for sending log msgs via e-mail
             server = smtplib.SMTP(host=config.HOST, port=config.PORT, timeout=10)
@@ -560,6 +1171,476 @@ class GenerateOutput:
             )
             sys.exit(1)
 
+    def spool_email(self) -> None:
+        """
+        Write the email template variables, recipient and attachments to the
+        digest spool directory for the script mode, to be sent in a combined
+        email by digest.py. The entry is written to a temporary file and
+        renamed, so the digest scheduler never reads a partial entry
+        """
+        spool_dir = os.path.join(os.getcwd(), config.DIGEST_DIR, self.script_mode)
+        spool_path = os.path.join(
+            spool_dir, f"{time.time_ns()}.{self.project_name}.{self.project_id}.json"
+        )
+        entry = {
+            "project": self.get_email_context(),
+            "recipient": self.email_recipient,
+            "attachments": self.get_attachments() if self.csv_contents else [],
+        }
+        try:
+            os.makedirs(spool_dir, exist_ok=True)
+            with open(f"{spool_path}.tmp", "w", encoding="utf-8") as spool_file:
+                json.dump(entry, spool_file)
+            os.replace(f"{spool_path}.tmp", spool_path)
+            logger.info(
+                f"Email contents have been spooled for the digest: {spool_path}"
+            )
+        except Exception as exception:
+            logger.error(
+                "There was a problem spooling the email for the digest, with "
+                f"the following exception: {exception}",
+            )
+            sys.exit(1)
+
+    def download_files(self) -> None:
+        """
+        Download the files in the urls dataframe into the GSTT_dir/subdir
+        layout beneath the download directory, or the project staging
+        directory for GSTT_dirs containing placeholders, if a download
+        directory was provided
+        """
+        if self.download_dir and self.url_dataframe is not None:
+            try:
+                summary = Downloader(self.download_dir, self.project_name).download_all(
+                    self.get_download_dataframe().to_dict("records")
+                )
+            except Exception as exception:
+                logger.error(
+                    "There was a problem downloading the files, with "
+                    f"the following exception: {exception}",
+                )
+                sys.exit(1)
+            if summary["failed"]:
+                logger.error(
+                    f"{len(summary['failed'])} files could not be downloaded: "
+                    f"{summary['failed']}"
+                )
+                sys.exit(1)
+        else:
+            logger.info("Files were not downloaded as no download was requested")
+
+    def check_complete(self) -> None:
+        """
+        Exit with the config-defined exit code if the deadline was exceeded,
+        after the outputs for what completed have been written and sent
+        """
+        if self.incomplete or self.missing_files:
+            logger.error(
+                "Outputs are incomplete as the deadline was exceeded. Incomplete "
+                f"searches: {self.incomplete}. Files without URLs: "
+                f"{len(self.missing_files)}"
+            )
+            sys.exit(config.DEADLINE_EXIT_CODE)
+
+
+class RefreshOutput(GenerateOutput):
+    """
+    Refresh the expired URLs in an existing duty CSV. Only expired URLs are
+    re-minted, in parallel, using the file IDs recorded in the URL manifest
+    written alongside the CSV, so the job listing and data object search are
+    not repeated. The file sizes recorded in the manifest are restored, so
+    the refreshed CSV can be sharded by size. The refreshed CSV, TXT and PS1
+    files keep the row order of the existing CSV, and the email is only
+    re-sent if requested
+
+    Methods
+        load_existing()
+            Load the existing CSV and its URL manifest
+        get_jobs()
+            Return the job IDs recorded in the URL manifest
+        get_data_dicts()
+            Count the files per file type in the existing CSV
+        create_url_dataframe()
+            Replace the expired URLs in the existing CSV
+        is_expired()
+            Check whether a URL has expired, or will expire within the
+            config-defined margin
+        refresh_url()
+            Create a new url for the file an expired URL points to
+        find_file()
+            Look up a file in the project by name and folder
+        send_email()
+            Send the email, if requested
+    """
+
+    def __init__(self, refresh_csv: str, resend: bool, *args, **kwargs):
+        """
+        Constructor for the RefreshOutput class
+            :param refresh_csv (str):   Path of the existing duty CSV
+            :param resend (bool):       Whether to re-send the email
+        """
+        self.refresh_csv = refresh_csv
+        self.resend = resend
+        self.csv_dataframe, self.url_info = self.load_existing()
+        super().__init__(*args, **kwargs)
+
+    def load_existing(self) -> tuple[pd.core.frame.DataFrame, dict]:
+        """
+        Load the existing CSV and its URL manifest. If there is no manifest,
+        URLs are checked against the server and file IDs looked up by name
+            :return csv_dataframe (tabular):    Dataframe of the existing CSV
+            :return url_info (dict):            Manifest jobs and per-URL file
+                                                ID and expiry time
+        """
+        manifest_path = self.refresh_csv.replace(".duty_csv.csv", ".duty_csv.urls.json")
+        try:
+            csv_dataframe = pd.read_csv(self.refresh_csv)
+            logger.info(f"Read {len(csv_dataframe)} rows from {self.refresh_csv}")
+            if os.path.exists(manifest_path):
+                with open(manifest_path, encoding="utf-8") as manifest_file:
+                    url_info = json.load(manifest_file)
+                logger.info(f"Read URL manifest {manifest_path}")
+            else:
+                logger.warning(
+                    f"No URL manifest found at {manifest_path}. URLs will be "
+                    "checked against the server and file IDs looked up by name"
+                )
+                url_info = {"jobs": [], "urls": {}}
+            return csv_dataframe, url_info
+        except Exception as exception:
+            logger.error(
+                f"Could not read existing CSV {self.refresh_csv}, with exception: "
+                f"{exception}"
+            )
+            sys.exit(1)
+
+    def get_jobs(self) -> list:
+        """
+        Return the job IDs recorded in the URL manifest
+            :return project_jobs (list): List of job dictionaries
+        """
+        return [{"id": job_id} for job_id in self.url_info["jobs"]]
+
+    def get_data_dicts(self) -> tuple[None, dict]:
+        """
+        Count the files per file type in the existing CSV
+            :return data_obj_dict (None):   No data objects are searched for
+            :return data_num_dict (dict):   Dictionary of number of files per
+                                            file type
+        """
+        data_num_dict = (
+            self.csv_dataframe.drop_duplicates(["Name", "Folder", "Type"])
+            .groupby("Type", sort=False)
+            .size()
+            .to_dict()
+        )
+        return None, data_num_dict
+
+    def create_url_dataframe(self) -> pd.core.frame.DataFrame | None:
+        """
+        Replace the expired URLs in the existing CSV, keeping the row order.
+        URLs are checked and re-minted in parallel, and the file ID, expiry
+        time and size recorded for each URL are added to the dataframe
+            :return dataframe (tabular) | None: Pandas dataframe containing
+                                                URL links, or None if the
+                                                existing CSV has no rows
+        """
+        if self.csv_dataframe.empty:
+            logger.info("No URLs dataframe was created as the existing CSV is empty")
+            return None
+        try:
+            dataframe = self.csv_dataframe.copy()
+            dataframe.index += 1  # Start sample numbering from 1
+            rows = dataframe.drop_duplicates("Url").set_index("Url")
+            urls = list(rows.index)
+            with ThreadPoolExecutor(max_workers=config.REFRESH_THREADS) as executor:
+                expired = [
+                    url
+                    for url, is_expired in zip(
+                        urls,
+                        executor.map(
+                            self.profiler.wrap(
+                                lambda url: self.is_expired(
+                                    url, rows.at[url, "Name"], rows.at[url, "Folder"]
+                                )
+                            ),
+                            urls,
+                        ),
+                    )
+                    if is_expired
+                ]
+                logger.info(f"{len(expired)} of {len(urls)} URLs require refreshing")
+                new_urls = dict(
+                    zip(
+                        expired,
+                        executor.map(
+                            self.profiler.wrap(
+                                lambda url: self.refresh_url(
+                                    url, rows.at[url, "Name"], rows.at[url, "Folder"]
+                                )
+                            ),
+                            expired,
+                        ),
+                    )
+                )
+            dataframe["Url"] = dataframe["Url"].map(lambda url: new_urls.get(url, url))
+            for column, key in (
+                ("File_ID", "file_id"),
+                ("Expires", "expires"),
+                ("Size", "size"),
+            ):
+                dataframe[column] = dataframe["Url"].map(
+                    lambda url: self.url_info["urls"][url].get(key)
+                )
+            logger.info(f"Refreshed {len(new_urls)} URLs")
+            return dataframe
+        except Exception as exception:
+            logger.error(
+                f"An error was encountered when refreshing the urls dataframe: {exception}"
+            )
+            sys.exit(1)
+
+    def is_expired(self, url: str, file_name: str, folder: str) -> bool:
+        """
+        Check whether a URL has expired, or will expire within the
+        config-defined margin, using the expiry time from the manifest. URLs
+        without an expiry time in the manifest are checked against the
+        server, and the file each valid URL points to is recorded so that it
+        can be written to the manifest
+            :param url (str):           DNAnexus URL
+            :param file_name (str):     File name
+            :param folder (str):        DNAnexus folder containing the file
+            :return (bool):             True if the URL requires refreshing
+        """
+        url_info = self.url_info["urls"].get(url)
+        if url_info and url_info["expires"] is not None:
+            return url_info["expires"] - config.REFRESH_MARGIN < time.time()
+        try:
+            response = requests.head(
+                url, allow_redirects=True, timeout=config.DOWNLOAD_TIMEOUT
+            )
+            expired = response.status_code >= 400
+        except requests.RequestException:
+            expired = True
+        if not expired and not url_info:
+            # The expiry time is not known, so later refreshes check the URL
+            # against the server again
+            self.url_info["urls"][url] = {
+                **self.find_file(file_name, folder),
+                "expires": None,
+            }
+        return expired
+
+    def refresh_url(self, url: str, file_name: str, folder: str) -> str:
+        """
+        Create a new url for the file an expired URL points to, using the file
+        ID from the manifest, or looking the file up by name and folder if the
+        URL is not in the manifest
+            :param url (str):           Expired DNAnexus URL
+            :param file_name (str):     File name
+            :param folder (str):        DNAnexus folder containing the file
+            :return new_url (str):      New DNAnexus URL for the file
+        """
+        file_info = self.url_info["urls"].get(url) or self.find_file(file_name, folder)
+        new_url = self.get_url(file_info["file_id"], self.project_id, file_name)
+        self.url_info["urls"][new_url] = {
+            "file_id": file_info["file_id"],
+            "expires": time.time() + config.URL_DURATION,
+            "size": file_info.get("size"),
+        }
+        return new_url
+
+    def find_file(self, file_name: str, folder: str) -> dict:
+        """
+        Look up a file in the project by name and folder
+            :param file_name (str):     File name
+            :param folder (str):        DNAnexus folder containing the file
+            :return (dict):             File ID and size of the file
+        """
+        try:
+            data_obj = dxpy.find_one_data_object(
+                classname="file",
+                project=self.project_id,
+                folder=folder,
+                name=file_name,
+                recurse=False,
+                describe={"fields": {"size": True}},
+            )
+            return {"file_id": data_obj["id"], "size": data_obj["describe"]["size"]}
+        except Exception as exception:
+            logger.error(
+                f"Could not find file {folder}/{file_name}, with exception: "
+                f"{exception}"
+            )
+            sys.exit(1)
+
+    def send_email(self) -> None:
+        """
+        Send the email, if requested
+        """
+        if self.resend:
+            super().send_email()
+        else:
+            logger.info("Email was not re-sent as this was not requested")
+
+
+class SnapshotOutput(GenerateOutput):
+    """
+    Run the GenerateOutput pipeline from a snapshot of a project's job and
+    data object listings, without contacting DNAnexus. Data objects are
+    matched against the current config regexes and folders locally, so config
+    changes can be tested against a real run offline. Only data objects that
+    were fetched by the run that exported the snapshot are available. URLs
+    are replaced with the config-defined snapshot URL and no email is sent.
+    Outputs are named with a distinct suffix, so replaying a snapshot in the
+    outputs directory of a real run does not overwrite that run's outputs,
+    and no URL manifest or snapshot is written
+
+    Methods
+        load_snapshot()
+            Load the jobs and data objects from the snapshot file
+        get_jobs()
+            Return the jobs from the snapshot
+        get_data_dicts()
+            Match the snapshot data objects against the config-defined regexp
+            patterns and folders
+        export_snapshot()
+            Log that the snapshot was not exported
+        get_url()
+            Return a placeholder URL for a file
+        create_url_manifest()
+            Log that the URL manifest was not written
+        send_email()
+            Log that the email was not sent
+        download_files()
+            Log that the files were not downloaded
+    """
+
+    OUTPUT_SUFFIX = "snapshot.duty_csv"
+
+    def __init__(self, snapshot_file: str, *args, **kwargs):
+        """
+        Constructor for the SnapshotOutput class
+            :param snapshot_file (str): Path of the snapshot file
+        """
+        self.snapshot_file = snapshot_file
+        self.snapshot_jobs, self.snapshot_data_objs = self.load_snapshot()
+        super().__init__(*args, **kwargs)
+
+    def load_snapshot(self) -> tuple[list, list]:
+        """
+        Load the jobs and data objects from the snapshot file. Data objects
+        found by more than one file type are only loaded once
+            :return jobs (list):        List of job dictionaries
+            :return data_objs (list):   List of data object dictionaries
+        """
+        jobs, data_objs = [], {}
+        try:
+            with gzip.open(self.snapshot_file, "rt", encoding="utf-8") as snapshot:
+                for line in snapshot:
+                    record = json.loads(line)
+                    if record["type"] == "header":
+                        logger.info(
+                            f"Loading snapshot of {record['project_name']} "
+                            f"({record['project_id']}) exported by duty_csv "
+                            f"{record['git_tag']}"
+                        )
+                    elif record["type"] == "job":
+                        jobs.append(record["data"])
+                    else:
+                        data_objs[record["data"]["id"]] = record["data"]
+        except Exception as exception:
+            logger.error(
+                f"Could not load snapshot {self.snapshot_file}, with exception: "
+                f"{exception}"
+            )
+            sys.exit(1)
+        logger.info(f"Loaded {len(jobs)} jobs and {len(data_objs)} data objects")
+        return jobs, list(data_objs.values())
+
+    def get_jobs(self) -> list:
+        """
+        Return the jobs from the snapshot
+            :return project_jobs (list): List of job dictionaries
+        """
+        logger.info(f"{len(self.snapshot_jobs)} jobs were identified in the snapshot")
+        return self.snapshot_jobs
+
+    def get_data_dicts(self) -> tuple[dict, dict] | tuple[None, None]:
+        """
+        Match the snapshot data objects against the config-defined regexp
+        patterns, and folders (including subdirectories)
+            :return data_obj_dict(dict) | None: Dictionary of data objects for
+                                                use in downloading files
+            :return data_num_dict(dict) | None: Dictionary of number of data
+                                                object per file type
+        """
+        if not self.file_dict:
+            logger.info(
+                "No DNAnexus data objects dictionary was created as the "
+                "config defines that this run will not have files for download"
+            )
+            return None, None
+        data_obj_dict, data_num_dict = {}, {}
+        for filetype in self.file_dict:
+            pattern = re.compile(self.file_dict[filetype]["regex"])
+            folder = self.file_dict[filetype]["folder"].rstrip("/")
+            data_obj_dict[filetype] = [
+                data_obj
+                for data_obj in self.snapshot_data_objs
+                if pattern.search(data_obj["describe"]["name"])
+                and f"{data_obj['describe']['folder']}/".startswith(f"{folder}/")
+            ]
+            data_num_dict[filetype] = len(data_obj_dict[filetype])
+            logger.info(
+                f"The number of items for {filetype} is {data_num_dict[filetype]}"
+            )
+        self.check_pannumbers(data_obj_dict)
+        return data_obj_dict, data_num_dict
+
+    def export_snapshot(self) -> None:
+        """
+        Log that the snapshot was not exported, as the snapshot being replayed
+        would be overwritten with only the data objects matched by the current
+        config
+        """
+        logger.info(
+            "No snapshot was exported as outputs were generated from a snapshot"
+        )
+
+    def get_url(self, file_id: str, project_id: str, file_name: str) -> str:
+        """
+        Return a placeholder URL for a file, as URLs are not minted when
+        replaying a snapshot
+            :return url (str): Placeholder URL for a file
+        """
+        return config.SNAPSHOT_URL.format(file_id=file_id, file_name=file_name)
+
+    def create_url_manifest(self) -> None:
+        """
+        Log that the URL manifest was not written, as the placeholder URLs
+        cannot be refreshed
+        """
+        logger.info(
+            "No URL manifest was created as outputs were generated from a snapshot"
+        )
+
+    def send_email(self) -> None:
+        """
+        Log that the email was not sent, as no email is sent when replaying a
+        snapshot
+        """
+        logger.info("Email was not sent as outputs were generated from a snapshot")
+
+    def download_files(self) -> None:
+        """
+        Log that the files were not downloaded, as the URLs are placeholders
+        when replaying a snapshot
+        """
+        logger.info(
+            "Files were not downloaded as outputs were generated from a snapshot"
+        )
+
 
 def arg_parse() -> dict:
     """
@@ -635,26 +1716,140 @@ def arg_parse() -> dict:
         default=False,
         required=False,
     )
+    parser.add_argument(
+        "-S",
+        "--shards",
+        type=int,
+        help=(
+            "Split the CSV into at least this many shards, balanced by total "
+            "file size, for parallel downloading"
+        ),
+        default=1,
+        required=False,
+    )
+    parser.add_argument(
+        "-D",
+        "--download",
+        type=str,
+        help=(
+            "Download the files directly into the GSTT_dir/subdir layout "
+            "beneath this directory"
+        ),
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "-R",
+        "--refresh",
+        type=str,
+        help=(
+            "Refresh the expired URLs in this existing duty CSV, instead of "
+            "generating a new CSV"
+        ),
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "--resend",
+        action="store_true",
+        help="Re-send the email after refreshing URLs",
+        default=False,
+        required=False,
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="Export the job and data object listings to a snapshot file",
+        default=False,
+        required=False,
+    )
+    parser.add_argument(
+        "--from_snapshot",
+        type=str,
+        help=(
+            "Generate outputs from this snapshot file, without contacting "
+            "DNAnexus or sending the email"
+        ),
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "--digest",
+        action="store_true",
+        help=(
+            "Spool the email to be sent in a combined digest email by "
+            "digest.py, instead of sending it"
+        ),
+        default=False,
+        required=False,
+    )
+    parser.add_argument(
+        "--deadline",
+        type=int,
+        help=(
+            "Deadline for the whole run in seconds, after which outputs are "
+            "produced for what completed (0 for no deadline)"
+        ),
+        default=config.RUN_DEADLINE,
+        required=False,
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        help=(
+            "DNAnexus requests per second shared by all duty_csv processes "
+            "using the same rate limit database (0 for no limit)"
+        ),
+        default=config.DX_RATE_LIMIT,
+        required=False,
+    )
+    parser.add_argument(
+        "--rate_limit_db",
+        type=str,
+        help="Path of the SQLite rate limit database shared by duty_csv processes",
+        default=os.path.join(os.getcwd(), config.DX_RATE_LIMIT_DB),
+        required=False,
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            "Write cProfile stats and tracemalloc top allocations for each "
+            "stage of the run to file"
+        ),
+        default=False,
+        required=False,
+    )
+    parser.add_argument(
+        "-W",
+        "--wait",
+        action="store_true",
+        help="Wait for all jobs in the project to finish before generating outputs",
+        default=False,
+        required=False,
+    )
     return vars(parser.parse_args())
 
 
-def update_tso_config_regex(tso_pannumbers: list) -> None:
+def update_tso_config_regex(tso_pannumbers: list) -> dict:
     """
-    Update config TSO500 regex incorporating command-line parsed Pan numbers
+    Return a copy of the config PER_RUNTYPE_DOWNLOADS with the TSO500 regex
+    incorporating command-line parsed Pan numbers. The config itself is not
+    modified, so that runs with different pan numbers can share the config
+        :return runtype_downloads (dict):   Files requiring download per
+                                            runtype
     """
     logger.info(
         f"Updating TSO500 regex with the following pan numbers: {tso_pannumbers}",
     )
     try:
-        for filetype in [
-            "gene_level_coverage",
-            "exon_level_coverage",
-        ]:
-            config.PER_RUNTYPE_DOWNLOADS["TSO500"][filetype]["regex"] = (
-                config.PER_RUNTYPE_DOWNLOADS["TSO500"][filetype]["regex"].format(
-                    ("|").join(tso_pannumbers)
-                )
-            )
+        runtype_downloads = copy.deepcopy(config.PER_RUNTYPE_DOWNLOADS)
+        pan_regex = build_alternation_regex(tso_pannumbers)
+        for filetype in config.TSO_PAN_FILETYPES:
+            runtype_downloads["TSO500"][filetype]["regex"] = runtype_downloads[
+                "TSO500"
+            ][filetype]["regex"].format(pan_regex)
+        return runtype_downloads
 
     except Exception as exception:
         logger.info(
@@ -664,32 +1859,63 @@ def update_tso_config_regex(tso_pannumbers: list) -> None:
         sys.exit(1)
 
 
-def git_tag() -> str:
+def build_alternation_regex(words: list) -> str:
     """
-    Obtain git tag from current commit
-        :return stdout (str):   String containing stdout,
-                                with newline characters removed
+    Build a regex matching any of the words, with common prefixes factored
+    into a trie-shaped pattern (e.g. Pan4969, Pan5085 and Pan5086 become
+    Pan(?:4969|508[56])), which is shorter and faster to match than a flat
+    alternation. Regex metacharacters in the words are escaped
+        :param words (list):    Words to match
+        :return (str):          Regex pattern
     """
-    filepath = os.path.dirname(os.path.realpath(__file__))
-    cmd = f"git -C {filepath} describe --tags --always --dirty"
-
-    proc = subprocess.Popen(
-        [cmd], stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True
-    )
-    out, _ = proc.communicate()
-    return out.rstrip().decode("utf-8")
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}  # End of word
+    return _trie_to_regex(trie) or ""
 
 
-if __name__ == "__main__":
-    args = arg_parse()
+def _trie_to_regex(node: dict) -> str | None:
+    """
+    Convert a trie node to a regex pattern
+        :param node (dict):     Trie node, mapping characters to child nodes,
+                                with an empty string key marking end of word
+        :return (str | None):   Regex pattern, or None if node is only an end
+                                of word
+    """
+    optional = "" in node
+    branches, chars = [], []
+    for char in sorted(char for char in node if char):
+        child = _trie_to_regex(node[char])
+        if child is None:
+            chars.append(re.escape(char))
+        else:
+            branches.append(re.escape(char) + child)
+    if not branches and not chars:
+        return None
+    # A lone character or character class can be quantified without a group
+    atomic = not branches
+    # Single character branches are merged into a character class
+    if len(chars) == 1:
+        branches.append(chars[0])
+    elif chars:
+        branches.append(f"[{''.join(chars)}]")
+    if len(branches) > 1:
+        pattern, atomic = f"(?:{'|'.join(branches)})", True
+    else:
+        pattern = branches[0]
+    if optional:
+        pattern = f"{pattern}?" if atomic else f"(?:{pattern})?"
+    return pattern
 
-    logfile_path = os.path.join(
-        os.getcwd(),
-        f"{args['project_name']}.{args['project_id']}.duty_csv.log",
-    )
-    logger = Logger(logfile_path).logger
-    logger.info(f"Running duty_csv {git_tag()}")
 
+def authenticate_dxpy() -> None:
+    """
+    Set the dxpy security context using the DNAnexus token in the
+    environment (DX_API_TOKEN), and check that dxpy is authenticated
+    """
     # Read access token from environment
     try:
         token = os.environ["DX_API_TOKEN"]
@@ -705,7 +1931,6 @@ if __name__ == "__main__":
 
     # Check dxpy is authenticated
     try:
-        token = os.environ["DX_API_TOKEN"]
         whoami = dxpy.api.system_whoami()
     except Exception as exception:
         logger.error(f"Unable to authenticate with DNAnexus API: {str(exception)}")
@@ -713,8 +1938,70 @@ if __name__ == "__main__":
     else:
         logger.info(f"Authenticated as {whoami}")
 
-    # Update PER_RUNTYPE_DOWNLOADS for TSO runs with Pan number regex
-    update_tso_config_regex(args["tso_pannumbers"])
+
+@functools.lru_cache(maxsize=None)
+def get_template(template_name: str, autoescape: bool) -> jinja2.Template:
+    """
+    Load a template from the config-defined template directory. Templates are
+    cached so they are only loaded once per process
+        :param template_name (str): Template file name
+        :param autoescape (bool):   Whether to autoescape HTML
+        :return (obj):              Jinja2 template object
+    """
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(config.TEMPLATE_DIR),
+        autoescape=autoescape,
+        keep_trailing_newline=True,
+    ).get_template(template_name)
+
+
+@functools.lru_cache(maxsize=None)
+def git_tag() -> str:
+    """
+    Obtain git tag from current commit
+        :return stdout (str):   String containing stdout,
+                                with newline characters removed
+    """
+    filepath = os.path.dirname(os.path.realpath(__file__))
+    cmd = f"git -C {filepath} describe --tags --always --dirty"
+
+    proc = subprocess.Popen(
+        [cmd], stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True
+    )
+    out, _ = proc.communicate()
+    return out.rstrip().decode("utf-8")
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+
+    logfile_path = os.path.join(
+        os.getcwd(),
+        f"{args['project_name']}.{args['project_id']}."
+        f"{'snapshot.' if args['from_snapshot'] else ''}duty_csv.log",
+    )
+    logger = Logger(logfile_path).logger
+    logger.info(f"Running duty_csv {git_tag()}")
+
+    if args["rate_limit"]:
+        RateLimiter(
+            args["rate_limit_db"], args["rate_limit"], config.DX_RATE_BURST
+        ).install()
+
+    if not args["from_snapshot"]:
+        authenticate_dxpy()
+
+    if args["wait"]:
+        JobWatcher(
+            args["project_id"],
+            os.path.join(
+                os.getcwd(),
+                f"{args['project_name']}.{args['project_id']}.duty_csv.watermark.json",
+            ),
+        ).wait()
+
+    # Populate PER_RUNTYPE_DOWNLOADS for TSO runs with Pan number regex
+    runtype_downloads = update_tso_config_regex(args["tso_pannumbers"])
 
     if args["testing"]:
         SCRIPT_MODE = "TEST"
@@ -723,7 +2010,14 @@ if __name__ == "__main__":
 
     logger.info(f"Script is being run in {SCRIPT_MODE} mode")
 
-    GenerateOutput(
+    if args["refresh"]:
+        output_class = functools.partial(RefreshOutput, args["refresh"], args["resend"])
+    elif args["from_snapshot"]:
+        output_class = functools.partial(SnapshotOutput, args["from_snapshot"])
+    else:
+        output_class = GenerateOutput
+
+    output_class(
         args["project_name"],
         args["project_id"],
         args["email_user"],
@@ -731,4 +2025,12 @@ if __name__ == "__main__":
         args["stg_pannumbers"],
         args["cp_capture_pannos"],
         SCRIPT_MODE,
+        shards=args["shards"],
+        download_dir=args["download"],
+        runtype_downloads=runtype_downloads,
+        profile=args["profile"],
+        tso_pannumbers=args["tso_pannumbers"],
+        snapshot=args["snapshot"],
+        digest=args["digest"],
+        deadline=args["deadline"],
     )
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""job_watcher.py
+
+Wait for all executions in a DNAnexus project to reach a terminal state,
+polling only the executions that have not yet finished
+"""
+import os
+import sys
+import json
+import time
+import logging
+import dxpy
+import config
+
+# Configured by logger.Logger in the calling script
+logger = logging.getLogger("logger")
+
+
+class JobWatcher:
+    """
+    Wait for all executions in a DNAnexus project to reach a terminal state.
+    The first poll lists all executions in the project. Later polls only list
+    executions created since the creation time watermark, and describe the
+    executions that were not yet in a terminal state, so the cost of each
+    poll scales with the number of unfinished executions rather than all
+    executions. The watermark and unfinished executions are persisted to a
+    state file between polls, so a restarted wait resumes from where it left
+    off
+
+    Methods
+        wait()
+            Poll until the project is quiescent, exiting if the config-defined
+            timeout is reached
+        poll()
+            Update the unfinished executions and watermark, and return the
+            number of unfinished executions
+        find_new_executions()
+            Return the states of executions created since the watermark
+        get_states()
+            Return the states of the unfinished executions
+        load_state()
+            Load the watermark and unfinished executions from the state file
+        save_state()
+            Save the watermark and unfinished executions to the state file
+    """
+
+    def __init__(self, project_id: str, state_path: str):
+        """
+        Constructor for the JobWatcher class
+            :param project_id (str):    DNAnexus project ID
+            :param state_path (str):    Path of the state file
+        """
+        self.project_id = project_id
+        self.state_path = state_path
+        self.watermark, self.watermark_ids, self.pending = self.load_state()
+
+    def wait(self) -> None:
+        """
+        Poll until all executions in the project are in a terminal state,
+        exiting if the config-defined timeout is reached
+        """
+        logger.info(f"Waiting for executions in {self.project_id} to finish")
+        start = time.monotonic()
+        while self.poll():
+            if time.monotonic() - start > config.JOB_WAIT_TIMEOUT:
+                logger.error(
+                    f"Timed out waiting for {len(self.pending)} executions to "
+                    f"finish: {sorted(self.pending)}"
+                )
+                sys.exit(1)
+            time.sleep(config.JOB_POLL_INTERVAL)
+        logger.info(f"All executions in {self.project_id} have finished")
+
+    def poll(self) -> int:
+        """
+        Update the unfinished executions and watermark, and save them to the
+        state file
+            :return (int):  Number of unfinished executions
+        """
+        try:
+            states = self.get_states()
+            states.update(self.find_new_executions())
+        except Exception as exception:
+            logger.error(
+                "There was a problem polling executions in the DNAnexus "
+                f"project: {exception}"
+            )
+            sys.exit(1)
+        self.pending = {
+            execution_id
+            for execution_id, state in states.items()
+            if state not in config.TERMINAL_JOB_STATES
+        }
+        self.save_state()
+        logger.info(f"{len(self.pending)} executions are not yet in a terminal state")
+        return len(self.pending)
+
+    def find_new_executions(self) -> dict:
+        """
+        Return the states of executions created since the watermark. The
+        watermark is inclusive, so executions created at the watermark that
+        have already been seen are skipped
+            :return states (dict):  Dictionary of execution ID: state
+        """
+        states = {}
+        for execution in dxpy.bindings.search.find_executions(
+            project=self.project_id,
+            created_after=self.watermark,
+            describe={"fields": {"state": True, "created": True}},
+        ):
+            if execution["id"] in self.watermark_ids:
+                continue
+            created = execution["describe"]["created"]
+            if self.watermark is None or created > self.watermark:
+                self.watermark, self.watermark_ids = created, set()
+            if created == self.watermark:
+                self.watermark_ids.add(execution["id"])
+            states[execution["id"]] = execution["describe"]["state"]
+        logger.info(f"{len(states)} new executions were found")
+        return states
+
+    def get_states(self) -> dict:
+        """
+        Return the states of the unfinished executions
+            :return states (dict):  Dictionary of execution ID: state
+        """
+        states = {}
+        for execution_id in self.pending:
+            if execution_id.startswith("analysis-"):
+                describe = dxpy.api.analysis_describe
+            else:
+                describe = dxpy.api.job_describe
+            execution = describe(execution_id, {"fields": {"state": True}})
+            states[execution_id] = execution["state"]
+        return states
+
+    def load_state(self) -> tuple[int | None, set, set]:
+        """
+        Load the watermark and unfinished executions from the state file
+            :return watermark (int | None): Creation time of the most recently
+                                            created execution (ms since epoch)
+            :return watermark_ids (set):    IDs of executions created at the
+                                            watermark
+            :return pending (set):          IDs of unfinished executions
+        """
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as state_file:
+                state = json.load(state_file)
+            logger.info(f"Resuming from watermark {state['watermark']}")
+            return (
+                state["watermark"],
+                set(state["watermark_ids"]),
+                set(state["pending"]),
+            )
+        return None, set(), set()
+
+    def save_state(self) -> None:
+        """
+        Save the watermark and unfinished executions to the state file
+        """
+        with open(self.state_path, "w", encoding="utf-8") as state_file:
+            json.dump(
+                {
+                    "watermark": self.watermark,
+                    "watermark_ids": sorted(self.watermark_ids),
+                    "pending": sorted(self.pending),
+                },
+                state_file,
+            )
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""prefetch.py
+
+Iterate over dxpy search results while the following results are fetched on a
+background thread, so that network round trips overlap with processing
+"""
+import time
+import queue
+import threading
+import config
+
+
+class PrefetchedSearch:
+    """
+    Iterate over the results of a dxpy search generator (e.g.
+    find_data_objects, find_executions). dxpy only requests the next page of
+    results once the caller has consumed the current page, so a search
+    listing many pages takes (number of pages) x (round trip). Here the
+    generator is consumed on a background thread into a bounded buffer, which
+    is large enough to hold a full page, so the next page is requested while
+    the current page is processed. The search starts when the object is
+    created, so several searches can be started to run concurrently.
+    Exceptions raised by the search are raised when iterating, and
+    TimeoutError is raised if the time limit passes while waiting for a
+    result
+
+    Methods
+        fetch()
+            Put the search results into the buffer
+        put()
+            Put an item into the buffer, unless the search has been closed
+        close()
+            Stop fetching results
+    """
+
+    def __init__(
+        self,
+        search: callable,
+        buffer_size: int = config.SEARCH_BUFFER,
+        time_limit: float | None = None,
+        wrap: callable = None,
+        **kwargs,
+    ):
+        """
+        Constructor for the PrefetchedSearch class
+            :param search (callable):           dxpy search generator function
+            :param buffer_size (int):           Maximum number of results
+                                                buffered
+            :param time_limit (float | None):   Seconds from the start of the
+                                                search to wait for results, or
+                                                None to wait indefinitely
+            :param wrap (callable | None):      Wrapper applied to the
+                                                function fetching the results
+                                                on the background thread (e.g.
+                                                to profile it)
+            :param kwargs:                      Search arguments
+        """
+        self.end = None if time_limit is None else time.monotonic() + time_limit
+        self.buffer = queue.Queue(maxsize=buffer_size)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(
+            target=wrap(self.fetch) if wrap else self.fetch,
+            args=(search, kwargs),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def __iter__(self):
+        """
+        Yield search results as they are fetched
+        """
+        try:
+            while True:
+                try:
+                    is_result, item = self.buffer.get(
+                        timeout=(
+                            None
+                            if self.end is None
+                            else max(0, self.end - time.monotonic())
+                        )
+                    )
+                except queue.Empty:
+                    raise TimeoutError("Search time limit exceeded")
+                if is_result:
+                    yield item
+                elif item:
+                    raise item
+                else:
+                    return
+        finally:
+            self.close()
+
+    def fetch(self, search: callable, kwargs: dict) -> None:
+        """
+        Put the search results into the buffer, followed by an end marker
+        holding the exception raised by the search, if any
+            :param search (callable):   dxpy search generator function
+            :param kwargs (dict):       Search arguments
+        """
+        try:
+            for result in search(**kwargs):
+                if not self.put((True, result)):
+                    return
+        except Exception as exception:
+            self.put((False, exception))
+        else:
+            self.put((False, None))
+
+    def put(self, item: tuple) -> bool:
+        """
+        Put an item into the buffer, waiting while the buffer is full, unless
+        the search has been closed
+            :param item (tuple):    (is result, result or exception) tuple
+            :return (bool):         False if the search has been closed
+        """
+        while not self.closed.is_set():
+            try:
+                self.buffer.put(item, timeout=config.SEARCH_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self) -> None:
+        """
+        Stop fetching results, e.g. if iteration was stopped early
+        """
+        self.closed.set()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""profiler.py
+
+Profile the stages of a duty_csv run, writing cProfile stats and tracemalloc
+top allocations for each stage to files alongside the log file
+"""
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import functools
+import tracemalloc
+import config
+
+# Configured by logger.Logger in the calling script
+logger = logging.getLogger("logger")
+
+
+class StageProfiler:
+    """
+    Run each stage of a duty_csv run, profiling it if profiling is enabled.
+    For each stage, the cProfile stats are written to a
+    <prefix>.<stage>.duty_csv.prof file (which can be loaded with pstats or
+    snakeviz), and the tracemalloc top allocations and peak memory to a
+    <prefix>.<stage>.duty_csv.mem.txt file. cProfile only profiles the thread
+    it is enabled on, so calls made on worker threads (e.g. search pagination
+    and URL creation) are profiled by wrapping them, and their stats are
+    merged into the stats of the stage running when each call finishes.
+    tracemalloc traces the whole process, so memory is only traced by one
+    profiler in the process at a time
+
+    Methods
+        run()
+            Run a stage, profiling it if profiling is enabled
+        wrap()
+            Wrap a function called on worker threads so that its calls are
+            profiled
+        write_memory_stats()
+            Write the top allocations and peak memory for a stage to file
+    """
+
+    tracemalloc_lock = threading.Lock()  # Held by the profiler tracing memory
+
+    def __init__(self, prefix: str, enabled: bool):
+        """
+        Constructor for the StageProfiler class
+            :param prefix (str):    Output file path prefix
+            :param enabled (bool):  Whether to profile stages
+        """
+        self.prefix = prefix
+        self.enabled = enabled
+        self.stage_thread = None  # ID of the thread running the stages
+        self.thread_stats = []  # Stats of calls made on worker threads
+        self.thread_stats_lock = threading.Lock()
+
+    def run(self, stage: callable):
+        """
+        Run a stage, profiling it if profiling is enabled. Profiles are
+        written even if the stage exits, so failed runs can be diagnosed
+            :param stage (callable):    Stage to run, named after its function
+            :return:                    Return value of the stage
+        """
+        if not self.enabled:
+            return stage()
+        name = stage.__name__
+        self.stage_thread = threading.get_ident()
+        profile = cProfile.Profile()
+        # Memory is not traced if another profiler in the process (e.g. in
+        # service mode) or another tool is already tracing it
+        trace_memory = StageProfiler.tracemalloc_lock.acquire(blocking=False)
+        if trace_memory and tracemalloc.is_tracing():
+            StageProfiler.tracemalloc_lock.release()
+            trace_memory = False
+        if trace_memory:
+            tracemalloc.start(config.PROFILE_TRACEBACK_FRAMES)
+        start = time.perf_counter()
+        try:
+            profile.enable()
+            return stage()
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            stats = pstats.Stats(profile)
+            with self.thread_stats_lock:
+                for thread_stats in self.thread_stats:
+                    stats.add(thread_stats)
+                self.thread_stats = []
+            stats.dump_stats(f"{self.prefix}.{name}.duty_csv.prof")
+            if trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                StageProfiler.tracemalloc_lock.release()
+                self.write_memory_stats(name, snapshot, peak)
+                logger.info(
+                    f"Stage {name} took {elapsed:.3f} seconds, peak traced memory "
+                    f"{peak / 1024 / 1024:.1f} MB"
+                )
+            else:
+                logger.info(
+                    f"Stage {name} took {elapsed:.3f} seconds. Memory was not "
+                    "traced as tracemalloc is in use elsewhere in the process"
+                )
+
+    def wrap(self, function: callable) -> callable:
+        """
+        Wrap a function called on worker threads so that, if profiling is
+        enabled, each call is profiled on the thread making it and the stats
+        are merged into the stats of the stage running when the call
+        finishes. Calls made on the thread running the stages are already
+        profiled by the stage profile
+            :param function (callable): Function to wrap
+            :return (callable):         Wrapped function
+        """
+        if not self.enabled:
+            return function
+
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            if threading.get_ident() == self.stage_thread:
+                return function(*args, **kwargs)
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                thread_stats = pstats.Stats(profile)
+                with self.thread_stats_lock:
+                    self.thread_stats.append(thread_stats)
+
+        return profiled
+
+    def write_memory_stats(
+        self, name: str, snapshot: tracemalloc.Snapshot, peak: int
+    ) -> None:
+        """
+        Write the top allocations and peak memory for a stage to file
+            :param name (str):      Stage name
+            :param snapshot (obj):  Tracemalloc snapshot taken after the stage
+            :param peak (int):      Peak traced memory during the stage (bytes)
+        """
+        with open(
+            f"{self.prefix}.{name}.duty_csv.mem.txt", "w", encoding="utf-8"
+        ) as memfile:
+            memfile.write(f"Peak traced memory: {peak} bytes\n")
+            memfile.write(f"Top {config.PROFILE_TOP_N} allocations by line:\n")
+            for statistic in snapshot.statistics("lineno")[: config.PROFILE_TOP_N]:
+                memfile.write(f"{statistic}\n")
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""rate_limiter.py
+
+Host-wide token bucket for DNAnexus API requests, shared through a SQLite file
+by every duty_csv process on the host, so that concurrent runs together stay
+below the configured request rate
+"""
+import time
+import sqlite3
+import logging
+import functools
+import contextlib
+import dxpy
+import config
+
+# Configured by logger.Logger in the calling script
+logger = logging.getLogger("logger")
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all processes using the same SQLite file. Each
+    request takes a token inside a write transaction, refilling the bucket at
+    the configured rate up to the burst size. If the bucket is empty, the
+    token is reserved anyway (the token count goes negative) and the caller
+    sleeps until its reserved token is due, so waiting callers are served in
+    the order they asked, and the time a request waits is predictable from
+    the number of requests queued ahead of it. Once installed, every dxpy API
+    request draws from the bucket
+
+    Methods
+        connect()
+            Yield a connection to the bucket database
+        acquire()
+            Take a token, sleeping until it is due
+        install()
+            Wrap dxpy's API request function so every request takes a token
+    """
+
+    BUCKET = "dnanexus"
+
+    def __init__(self, db_path: str, rate: float, burst: int):
+        """
+        Constructor for the RateLimiter class
+            :param db_path (str):   Path of the SQLite bucket database
+            :param rate (float):    Requests per second across all processes
+            :param burst (int):     Maximum number of tokens in the bucket
+        """
+        self.db_path = db_path
+        self.rate = rate
+        self.burst = burst
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS bucket "
+                "(name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO bucket VALUES (?, ?, ?)",
+                (self.BUCKET, burst, time.time()),
+            )
+
+    @contextlib.contextmanager
+    def connect(self) -> sqlite3.Connection:
+        """
+        Yield a connection to the bucket database in autocommit mode, closing
+        it afterwards
+            :return connection (obj):   SQLite connection object
+        """
+        connection = sqlite3.connect(
+            self.db_path, timeout=config.DX_RATE_LIMIT_DB_TIMEOUT, isolation_level=None
+        )
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def acquire(self) -> None:
+        """
+        Take a token, sleeping until it is due if the bucket is empty. If the
+        bucket database cannot be used, the request is not limited rather
+        than failing the run
+        """
+        try:
+            with self.connect() as connection:
+                # Take the write lock before reading so updates cannot interleave
+                connection.execute("BEGIN IMMEDIATE")
+                tokens, updated = connection.execute(
+                    "SELECT tokens, updated FROM bucket WHERE name = ?",
+                    (self.BUCKET,),
+                ).fetchone()
+                now = time.time()
+                tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+                connection.execute(
+                    "UPDATE bucket SET tokens = ?, updated = ? WHERE name = ?",
+                    (tokens, now, self.BUCKET),
+                )
+                connection.execute("COMMIT")
+        except sqlite3.Error as exception:
+            logger.warning(
+                f"DNAnexus request was not rate limited, as the rate limit "
+                f"database {self.db_path} could not be used: {exception}"
+            )
+            return
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
+    def install(self) -> None:
+        """
+        Wrap dxpy's API request function, which all dxpy API calls and
+        searches are made through, so every request takes a token. Retries
+        made by dxpy within a request do not take further tokens
+        """
+        request = dxpy.DXHTTPRequest
+        if getattr(request, "rate_limiter", None):
+            logger.info("DNAnexus requests are already rate limited")
+            return
+
+        @functools.wraps(request)
+        def limited_request(*args, **kwargs):
+            self.acquire()
+            return request(*args, **kwargs)
+
+        limited_request.rate_limiter = self
+        dxpy.DXHTTPRequest = limited_request
+        dxpy.api.DXHTTPRequest = limited_request
+        logger.info(
+            f"DNAnexus requests are limited to {self.rate} per second across "
+            f"the host, using {self.db_path}"
+        )
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""service.py
+
+Long-running service mode for duty_csv. Authenticates with DNAnexus and loads
+the templates once at startup, then accepts run requests on a local HTTP
+endpoint and processes them on a pool of worker threads
+"""
+import os
+import sys
+import json
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import config
+import duty_csv
+from logger import Logger
+from job_watcher import JobWatcher
+from rate_limiter import RateLimiter
+
+# Configured by logger.Logger when the service is started
+logger = duty_csv.logger
+
+
+class DutyService:
+    """
+    Run GenerateOutput for submitted run requests on a pool of worker
+    threads. Concurrent requests for a project that is already queued or
+    running are de-duplicated, returning the status of the existing run
+
+    Methods
+        submit()
+            Validate a run request and queue it for processing, unless a run
+            for the same project is already queued or running
+        get_status()
+            Return the status of all runs, or of the run for one project
+        run()
+            Run GenerateOutput for a request, recording the outcome
+    """
+
+    REQUIRED_FIELDS = [
+        "project_name",
+        "project_id",
+        "tso_pannumbers",
+        "stg_pannumbers",
+        "cp_capture_pannos",
+    ]
+
+    def __init__(self, email_user: str, email_pw: str, workers: int):
+        """
+        Constructor for the DutyService class
+            :param email_user (str):    Mail server username
+            :param email_pw (str):      Mail server password
+            :param workers (int):       Number of runs to process at once
+        """
+        self.email_user = email_user
+        self.email_pw = email_pw
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.runs = {}
+
+    def submit(self, request: dict) -> tuple[dict, bool]:
+        """
+        Validate a run request and queue it for processing, unless a run for
+        the same project is already queued or running
+            :param request (dict):  Run request
+            :return status (dict):  Status of the queued or existing run
+            :return queued (bool):  True if a new run was queued
+        """
+        if not isinstance(request, dict):
+            raise ValueError("Run request must be a JSON object")
+        missing = [field for field in self.REQUIRED_FIELDS if not request.get(field)]
+        if missing:
+            raise ValueError(f"Run request is missing fields: {missing}")
+        if request.get("mode", "PROD") not in config.EMAIL_RECIPIENT:
+            raise ValueError(f"Run request has invalid mode: {request['mode']}")
+        project_id = request["project_id"]
+        with self.lock:
+            existing = self.runs.get(project_id)
+            if existing and existing["state"] in ("queued", "running"):
+                logger.info(
+                    f"Run request for {project_id} de-duplicated as a run is "
+                    f"already {existing['state']}"
+                )
+                return dict(existing), False
+            status = {
+                "project_name": request["project_name"],
+                "project_id": project_id,
+                "mode": request.get("mode", "PROD"),
+                "state": "queued",
+                "submitted": datetime.now().isoformat(),
+            }
+            self.runs[project_id] = status
+            self.executor.submit(self.run, request, status)
+            logger.info(f"Run request for {project_id} queued")
+            return dict(status), True
+
+    def get_status(self, project_id: str | None = None) -> dict | list | None:
+        """
+        Return the status of all runs, or of the run for one project
+            :param project_id (str | None): DNAnexus project ID
+            :return (dict | list | None):   Run status, list of run statuses,
+                                            or None if project has no run
+        """
+        with self.lock:
+            if project_id:
+                status = self.runs.get(project_id)
+                return dict(status) if status else None
+            return [dict(status) for status in self.runs.values()]
+
+    def run(self, request: dict, status: dict) -> None:
+        """
+        Run GenerateOutput for a request, recording the outcome in the status.
+        GenerateOutput exits on failure, so SystemExit is caught to keep the
+        worker thread alive
+            :param request (dict):  Run request
+            :param status (dict):   Status of the run
+        """
+        with self.lock:
+            status.update(state="running", started=datetime.now().isoformat())
+        logger.info(f"Running duty_csv for {status['project_id']}")
+        try:
+            if request.get("wait"):
+                JobWatcher(
+                    request["project_id"],
+                    os.path.join(
+                        os.getcwd(),
+                        f"{request['project_name']}.{request['project_id']}"
+                        ".duty_csv.watermark.json",
+                    ),
+                ).wait()
+            output = duty_csv.GenerateOutput(
+                request["project_name"],
+                request["project_id"],
+                self.email_user,
+                self.email_pw,
+                request["stg_pannumbers"],
+                request["cp_capture_pannos"],
+                status["mode"],
+                shards=request.get("shards", 1),
+                download_dir=request.get("download"),
+                runtype_downloads=duty_csv.update_tso_config_regex(
+                    request["tso_pannumbers"]
+                ),
+                tso_pannumbers=request["tso_pannumbers"],
+                digest=request.get("digest", False),
+            )
+            result = {
+                "state": "completed",
+                "runtype": output.runtype,
+                "number_of_files": output.number_of_files,
+                "num_jobs": len(output.project_jobs),
+                "outputs": [
+                    path
+                    for path in (
+                        output.csvfile_path,
+                        output.txtfile_path,
+                        output.ps1file_path,
+                        output.htmlfile_path,
+                    )
+                    if os.path.exists(path)
+                ],
+            }
+        except SystemExit as exception:
+            if exception.code == config.DEADLINE_EXIT_CODE:
+                state = "partial"  # Outputs were produced for what completed
+            else:
+                state = "failed"
+            result = {"state": state, "exit_code": exception.code}
+        except Exception as exception:
+            logger.error(
+                f"Run for {status['project_id']} failed, with exception: {exception}"
+            )
+            result = {"state": "failed", "error": str(exception)}
+        with self.lock:
+            status.update(result, finished=datetime.now().isoformat())
+        logger.info(f"Run for {status['project_id']} {status['state']}")
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler for the service endpoint
+        POST /runs              Submit a run request (JSON body)
+        GET /runs               Return the status of all runs
+        GET /runs/<project_id>  Return the status of the run for a project
+
+    Methods
+        do_GET()
+            Return run statuses
+        do_POST()
+            Submit a run request
+        send_json()
+            Send a JSON response
+    """
+
+    service = None  # DutyService instance, set when the service is started
+
+    def do_GET(self) -> None:
+        """
+        Return the status of all runs, or of the run for one project
+        """
+        path = self.path.rstrip("/").split("/")
+        if path[1:2] != ["runs"] or len(path) > 3:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        status = self.service.get_status(path[2] if len(path) == 3 else None)
+        if status is None:
+            self.send_json(404, {"error": f"No run found for {path[2]}"})
+        else:
+            self.send_json(200, status)
+
+    def do_POST(self) -> None:
+        """
+        Submit a run request. Responds 202 if a new run was queued, or 200
+        with the existing run status if the project is already queued or
+        running
+        """
+        if self.path.rstrip("/") != "/runs":
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            status, queued = self.service.submit(json.loads(self.rfile.read(length)))
+        except ValueError as exception:
+            self.send_json(400, {"error": str(exception)})
+        else:
+            self.send_json(202 if queued else 200, status)
+
+    def send_json(self, code: int, body: dict | list) -> None:
+        """
+        Send a JSON response
+            :param code (int):          HTTP status code
+            :param body (dict | list):  Response body
+        """
+        contents = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    def log_message(self, format: str, *args) -> None:
+        """
+        Write request logs to the service log rather than stderr
+        """
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+def arg_parse() -> dict:
+    """
+    Parse arguments supplied by the command line. Create argument parser,
+    define command line arguments, then parse supplied command line arguments
+    using the created argument parser
+        :return (dict): Parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run duty_csv as a long-running service, accepting run requests "
+            "on a local HTTP endpoint"
+        )
+    )
+    requirednamed = parser.add_argument_group("Required named arguments")
+    requirednamed.add_argument(
+        "-EU",
+        "--email_user",
+        type=str,
+        help="Username for mail server",
+        required=True,
+    )
+    requirednamed.add_argument(
+        "-PW",
+        "--email_pw",
+        type=str,
+        help="Password for mail server",
+        required=True,
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        help="Address to listen on",
+        default=config.SERVICE_HOST,
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        help="Port to listen on",
+        default=config.SERVICE_PORT,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of runs to process at once",
+        default=config.SERVICE_WORKERS,
+    )
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+
+    logger = Logger(os.path.join(os.getcwd(), config.SERVICE_LOGFILE)).logger
+    logger.info(f"Starting duty_csv service {duty_csv.git_tag()}")
+
+    if config.DX_RATE_LIMIT:
+        RateLimiter(
+            os.path.join(os.getcwd(), config.DX_RATE_LIMIT_DB),
+            config.DX_RATE_LIMIT,
+            config.DX_RATE_BURST,
+        ).install()
+
+    # Warm up authentication and templates so that run requests do not pay
+    # for them
+    duty_csv.authenticate_dxpy()
+    duty_csv.get_template(config.EMAIL_TEMPLATE, autoescape=True)
+    duty_csv.get_template(config.POWERSHELL_TEMPLATE, autoescape=False)
+
+    RequestHandler.service = DutyService(
+        args["email_user"], args["email_pw"], args["workers"]
+    )
+    server = ThreadingHTTPServer((args["host"], args["port"]), RequestHandler)
+    logger.info(f"Listening on {args['host']}:{args['port']}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Service stopped")
+        server.server_close()
+        sys.exit(0)
@@ -0,0 +1,62 @@
+# Generated by duty_csv/{{ git_tag }} for {{ project_name }}
+#
+# Downloads the files listed in the duty CSV in parallel batches, placing each
+# file directly in its GSTT_dir + subdir target directory. Files whose target
+# directory contains placeholders that are populated by process_duty_csv are
+# downloaded to the staging directory, and must be copied to the directories
+# specified in the CSV file
+param(
+    [int]$MaxJobs = {{ max_jobs }},
+    [int]$Retries = {{ retries }},
+    [string]$StagingDir = (Join-Path $env:USERPROFILE "Downloads\{{ project_name }}")
+)
+
+$Rows = @(
+{%- for row in rows %}
+    @{ Url = '{{ row.Url }}'; Dir = '{{ row.Dir }}'; Subdir = '{{ row.Subdir }}'; Name = '{{ row.Name }}' }
+{%- endfor %}
+)
+
+$Download = {
+    param($Url, $Dir, $Name, $Retries)
+    $Target = Join-Path $Dir $Name
+    for ($Attempt = 1; $Attempt -le $Retries + 1; $Attempt++) {
+        try {
+            New-Item -ItemType Directory -Force -Path $Dir | Out-Null
+            Invoke-WebRequest -Uri $Url -OutFile $Target -UseBasicParsing -ErrorAction Stop
+            return "OK $Target"
+        } catch {
+            if ($Attempt -gt $Retries) {
+                return "FAILED $Target : $_"
+            }
+            Start-Sleep -Seconds (5 * $Attempt)
+        }
+    }
+}
+
+$Jobs = @()
+foreach ($Row in $Rows) {
+    # Bound the number of downloads running at once
+    while (@($Jobs | Where-Object { $_.State -eq "Running" }).Count -ge $MaxJobs) {
+        Start-Sleep -Milliseconds 500
+    }
+    $Dir = $Row.Dir
+    if (-not $Dir) {
+        $Dir = $StagingDir
+        if ($Row.Subdir) {
+            $Dir = Join-Path $StagingDir $Row.Subdir
+        }
+    }
+    Write-Host "Downloading $($Row.Name) to $Dir"
+    $Jobs += Start-Job -ScriptBlock $Download -ArgumentList $Row.Url, $Dir, $Row.Name, $Retries
+}
+
+$Results = @($Jobs | Wait-Job | Receive-Job)
+$Jobs | Remove-Job
+$Failed = @($Results | Where-Object { $_ -like "FAILED*" })
+$Results | ForEach-Object { Write-Host $_ }
+Write-Host "$($Results.Count - $Failed.Count) of $($Rows.Count) files downloaded"
+if ($Failed.Count) {
+    Write-Host "$($Failed.Count) files failed to download" -ForegroundColor Red
+    exit 1
+}
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""test_downloader.py
+
+Test the downloader against a local HTTP server standing in for the DNAnexus
+download host, covering resume of partial downloads using range requests,
+servers that ignore range requests, and checksum verification
+"""
+import os
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from downloader import Downloader
+
+CONTENTS = bytes(range(256)) * 4096  # 1 MiB
+MD5 = hashlib.md5(CONTENTS).hexdigest()
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """
+    Serve the server's contents, honouring range requests unless the server
+    is set to ignore them. Range headers received are recorded on the server
+
+    Methods
+        do_GET()
+            Serve the file, or the requested range of the file
+        log_message()
+            Drop request log messages
+    """
+
+    def do_GET(self):
+        """
+        Serve the file, or the requested range of the file
+        """
+        contents = self.server.contents
+        range_header = self.headers.get("Range")
+        self.server.ranges.append(range_header)
+        if range_header and not self.server.ignore_range:
+            offset = int(range_header[len("bytes=") :].rstrip("-"))
+            if offset >= len(contents):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {offset}-{len(contents) - 1}/{len(contents)}"
+            )
+            contents = contents[offset:]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    def log_message(self, *args):
+        """
+        Drop request log messages
+        """
+
+
+class TestDownloader(unittest.TestCase):
+    """
+    Test the downloader against a local HTTP server
+    """
+
+    def setUp(self):
+        """
+        Start the local HTTP server and create the download directory
+        """
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+        self.server.contents = CONTENTS
+        self.server.ignore_range = False
+        self.server.ranges = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.downloader = Downloader(self.tempdir.name, "NGS600_run", retries=0)
+        self.row = {
+            "Name": "NGS600_01_Pan4000.txt",
+            "Url": f"http://127.0.0.1:{self.server.server_port}/file",
+            "GSTT_dir": "P:/DNA LAB/Current/TEST/",
+            "subdir": "coverage/",
+            "Size": len(CONTENTS),
+            "MD5": MD5,
+            "Parts": None,
+        }
+        self.target = self.downloader.get_target_path(self.row)
+        os.makedirs(os.path.dirname(self.target))
+
+    def tearDown(self):
+        """
+        Stop the local HTTP server and remove the download directory
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        self.tempdir.cleanup()
+
+    def write_partial(self, length: int) -> None:
+        """
+        Write the first bytes of the file to the partial download file
+            :param length (int):    Number of bytes to write
+        """
+        with open(f"{self.target}.part", "wb") as partial_file:
+            partial_file.write(CONTENTS[:length])
+
+    def read_target(self) -> bytes:
+        """
+        Read the downloaded file
+            :return (bytes):    Downloaded file contents
+        """
+        with open(self.target, "rb") as target_file:
+            return target_file.read()
+
+    def test_target_path(self):
+        """
+        GSTT_dir is mirrored beneath the download directory
+        """
+        self.assertEqual(
+            self.target,
+            os.path.join(
+                self.tempdir.name,
+                "P",
+                "DNA LAB",
+                "Current",
+                "TEST",
+                "coverage",
+                self.row["Name"],
+            ),
+        )
+
+    def test_placeholder_target_path(self):
+        """
+        GSTT_dirs with placeholders are downloaded to the staging directory
+        """
+        self.row["GSTT_dir"] = "P:/DNA LAB/Current/NGS worksheets/%s%s/"
+        self.assertEqual(
+            self.downloader.get_target_path(self.row),
+            os.path.join(self.tempdir.name, "NGS600_run", "coverage", self.row["Name"]),
+        )
+
+    def test_no_gstt_dir(self):
+        """
+        Files without a GSTT_dir are downloaded to the staging directory, and
+        rows whose target path cannot be found are counted as failed without
+        stopping the other downloads
+        """
+        no_gstt_dir = dict(self.row, GSTT_dir=False, Name="NGS600_02_Pan4009.txt")
+        no_name = dict(self.row, Name=None)
+        summary = self.downloader.download_all([self.row, no_gstt_dir, no_name])
+        self.assertEqual(summary["downloaded"], 2)
+        self.assertEqual(summary["failed"], [None])
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(
+                    self.tempdir.name, "NGS600_run", "coverage", no_gstt_dir["Name"]
+                )
+            )
+        )
+
+    def test_download(self):
+        """
+        Duplicate rows are downloaded once, and throughput is reported
+        """
+        summary = self.downloader.download_all([self.row, dict(self.row)])
+        self.assertEqual(summary["downloaded"], 1)
+        self.assertEqual(summary["bytes"], len(CONTENTS))
+        self.assertFalse(summary["failed"])
+        self.assertGreater(summary["throughput"], 0)
+        self.assertEqual(self.read_target(), CONTENTS)
+
+    def test_resume(self):
+        """
+        Partial downloads are resumed using a range request
+        """
+        self.write_partial(1000)
+        transferred = self.downloader.download_file(self.row, self.target)
+        self.assertEqual(self.server.ranges, ["bytes=1000-"])
+        self.assertEqual(transferred, len(CONTENTS) - 1000)
+        self.assertEqual(self.read_target(), CONTENTS)
+        self.assertFalse(os.path.exists(f"{self.target}.part"))
+
+    def test_range_ignored(self):
+        """
+        Partial downloads are restarted if the range request is ignored
+        """
+        self.server.ignore_range = True
+        self.write_partial(1000)
+        transferred = self.downloader.download_file(self.row, self.target)
+        self.assertEqual(self.server.ranges, ["bytes=1000-"])
+        self.assertEqual(transferred, len(CONTENTS))
+        self.assertEqual(self.read_target(), CONTENTS)
+
+    def test_md5_mismatch(self):
+        """
+        Corrupt downloads fail verification and are removed
+        """
+        self.server.contents = CONTENTS[:-1] + b"\x00"
+        with self.assertRaises(ValueError):
+            self.downloader.download_file(self.row, self.target)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertFalse(os.path.exists(f"{self.target}.part"))
+
+    def test_already_downloaded(self):
+        """
+        Verified files already present are not downloaded again
+        """
+        with open(self.target, "wb") as target_file:
+            target_file.write(CONTENTS)
+        self.assertEqual(self.downloader.download_file(self.row, self.target), 0)
+        self.assertEqual(self.server.ranges, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""test_refresh.py
+
+Test refreshing the URLs in an existing duty CSV, with and without the URL
+manifest written alongside it, and sharding the refreshed CSV, with dxpy,
+requests and the mail server mocked out
+"""
+import os
+import glob
+import json
+import tempfile
+import unittest
+from unittest import mock
+import pandas as pd
+import duty_csv
+
+PROJECT_NAME = "002_SNP_run"
+PROJECT_ID = "project-000000000000000000000000"
+DATA_OBJS = [
+    {
+        "id": f"file-{number:024d}",
+        "project": PROJECT_ID,
+        "describe": {
+            "id": f"file-{number:024d}",
+            "name": f"NGS600_{number:02d}.sites_present_reheader_filtered_normalised.vcf",
+            "folder": "/output",
+            "size": 1024 * (number + 1),
+            "parts": {"1": {"size": 1024 * (number + 1)}},
+        },
+    }
+    for number in range(6)
+]
+
+
+class FakeDXFile:
+    """
+    Stand-in for dxpy.DXFile that returns a new URL on each call without
+    contacting DNAnexus
+
+    Methods
+        get_download_url()
+            Return a URL for the file
+    """
+
+    minted = 0
+
+    def __init__(self, file_id: str):
+        """
+        Constructor for the FakeDXFile class
+            :param file_id (str):   DNAnexus file ID
+        """
+        self.file_id = file_id
+
+    def get_download_url(self, filename: str, **kwargs) -> list:
+        """
+        Return a new URL for the file
+            :param filename (str):  File name
+            :return (list):         URL and headers, as returned by dxpy
+        """
+        FakeDXFile.minted += 1
+        return [
+            f"https://dl.dnanex.us/F/D/{self.file_id}/{FakeDXFile.minted}/{filename}",
+            {},
+        ]
+
+
+def find_one_data_object(name: str, **kwargs) -> dict:
+    """
+    Stand-in for dxpy.find_one_data_object that looks the file up by name
+        :param name (str):  File name
+        :return (dict):     Data object
+    """
+    return next(
+        data_obj for data_obj in DATA_OBJS if data_obj["describe"]["name"] == name
+    )
+
+
+class TestRefresh(unittest.TestCase):
+    """
+    Test refreshing the URLs in a duty CSV generated from mocked DNAnexus
+    listings
+    """
+
+    def setUp(self):
+        """
+        Generate the duty CSV and URL manifest in a temporary directory
+        """
+        self.cwd = os.getcwd()
+        self.tempdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tempdir.name)
+        self.patches = [
+            mock.patch.object(duty_csv.dxpy, "DXFile", FakeDXFile),
+            mock.patch.object(
+                duty_csv.dxpy, "find_one_data_object", find_one_data_object
+            ),
+            mock.patch.object(
+                duty_csv.dxpy.bindings.search,
+                "find_data_objects",
+                lambda **kwargs: iter(DATA_OBJS),
+            ),
+            mock.patch.object(
+                duty_csv.dxpy.bindings.search,
+                "find_executions",
+                lambda **kwargs: iter([{"id": "job-1", "describe": {"state": "done"}}]),
+            ),
+            mock.patch.object(duty_csv.smtplib, "SMTP"),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.output = self.run_output(duty_csv.GenerateOutput)
+
+    def tearDown(self):
+        """
+        Stop the mocks and remove the temporary directory
+        """
+        for patch in self.patches:
+            patch.stop()
+        os.chdir(self.cwd)
+        self.tempdir.cleanup()
+
+    def run_output(self, output_class: callable, **kwargs) -> duty_csv.GenerateOutput:
+        """
+        Run an output class for the project
+            :param output_class (callable): GenerateOutput class or partial
+            :return (obj):                  Output class instance
+        """
+        return output_class(
+            PROJECT_NAME,
+            PROJECT_ID,
+            "user",
+            "password",
+            [],
+            [],
+            "TEST",
+            deadline=None,
+            **kwargs,
+        )
+
+    def refresh(self, **kwargs) -> duty_csv.RefreshOutput:
+        """
+        Refresh the URLs in the generated CSV
+            :return (obj):  RefreshOutput instance
+        """
+        return self.run_output(
+            lambda *args, **output_kwargs: duty_csv.RefreshOutput(
+                self.output.csvfile_path, False, *args, **output_kwargs
+            ),
+            **kwargs,
+        )
+
+    def expire_manifest(self) -> None:
+        """
+        Set the expiry time of every URL in the manifest to 0
+        """
+        with open(self.output.manifest_path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        for url_info in manifest["urls"].values():
+            url_info["expires"] = 0
+        with open(self.output.manifest_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+    def test_refresh_expired(self):
+        """
+        Expired URLs are replaced, and the manifest records the new URLs
+        """
+        old_urls = set(self.output.url_dataframe["Url"])
+        self.expire_manifest()
+        refresh = self.refresh()
+        self.assertFalse(old_urls & set(refresh.url_dataframe["Url"]))
+        with open(self.output.manifest_path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(set(manifest["urls"]), set(refresh.url_dataframe["Url"]))
+
+    def test_refresh_shards(self):
+        """
+        Refreshed CSVs are sharded by the file sizes from the manifest
+        """
+        self.expire_manifest()
+        refresh = self.refresh(shards=2)
+        self.assertEqual(
+            list(refresh.url_dataframe["Size"]),
+            list(self.output.url_dataframe["Size"]),
+        )
+        self.assertEqual(len(refresh.shard_files), 2)
+        shards = [
+            pd.read_csv(path)
+            for path in sorted(glob.glob("*.shard*of2.duty_csv.csv"))
+        ]
+        self.assertEqual(sum(len(shard) for shard in shards), len(DATA_OBJS))
+
+    def test_refresh_without_manifest(self):
+        """
+        Without a manifest, URLs are checked against the server, only invalid
+        URLs are replaced, and the file IDs and sizes of all URLs are looked
+        up and written to the new manifest
+        """
+        os.remove(self.output.manifest_path)
+        old_urls = list(self.output.url_dataframe["Url"])
+        responses = {url: mock.Mock(status_code=200) for url in old_urls}
+        responses[old_urls[0]] = mock.Mock(status_code=403)
+        with mock.patch.object(
+            duty_csv.requests, "head", lambda url, **kwargs: responses[url]
+        ):
+            refresh = self.refresh(shards=2)
+        new_urls = list(refresh.url_dataframe["Url"])
+        self.assertNotEqual(new_urls[0], old_urls[0])
+        self.assertEqual(new_urls[1:], old_urls[1:])
+        self.assertEqual(
+            list(refresh.url_dataframe["File_ID"]),
+            list(self.output.url_dataframe["File_ID"]),
+        )
+        self.assertEqual(len(refresh.shard_files), 2)
+        with open(self.output.manifest_path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertIsNone(manifest["urls"][old_urls[1]]["expires"])
+        self.assertIsNotNone(manifest["urls"][new_urls[0]]["expires"])
+
+    def test_shards_without_sizes(self):
+        """
+        CSVs without file sizes are sharded by number of files
+        """
+        self.output.url_dataframe["Size"] = None
+        self.output.shards = 3
+        self.assertEqual(
+            [len(indices) for indices in self.output.get_shard_indices()], [2, 2, 2]
+        )
+
+    def shard_sizes(self, sizes: list, shards: int) -> list:
+        """
+        Shard rows with the given sizes, all in one destination directory
+            :param sizes (list):    File size of each row
+            :param shards (int):    Requested number of shards
+            :return (list):         Sorted list of the sizes in each shard
+        """
+        self.output.url_dataframe = pd.DataFrame(
+            {"GSTT_dir": "P:/DNA LAB/", "subdir": "VCFs", "Size": sizes}
+        )
+        self.output.shards = shards
+        shard_sizes = [
+            sorted(self.output.url_dataframe["Size"][indices].fillna(0))
+            for indices in self.output.get_shard_indices()
+        ]
+        self.assertEqual(
+            sum(len(shard) for shard in shard_sizes), len(sizes), "Rows were lost"
+        )
+        return sorted(shard_sizes)
+
+    def test_shards_with_zero_and_missing_sizes(self):
+        """
+        Zero byte files and files with unknown sizes do not stop the packing
+        loop from finishing, and each non-zero file that would unbalance the
+        shards is split from the others
+        """
+        self.assertEqual(self.shard_sizes([0, 0, 100], 2), [[0, 0], [100]])
+        self.assertEqual(
+            [sum(shard) for shard in self.shard_sizes([None, None, 100, 50, 50], 2)],
+            [100, 100],
+        )
+        self.assertEqual(self.shard_sizes([0, 0, 0], 2), [[0, 0, 0]])
+
+    def test_shards_with_dominant_file(self):
+        """
+        A file larger than all others combined gets a shard of its own
+        """
+        self.assertEqual(
+            self.shard_sizes([1, 1, 1000, 1, 1], 2), [[1, 1, 1, 1], [1000]]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+"""work_queue.py
+
+SQLite-backed work queue that allows several worker processes or hosts to
+share the processing of a backlog of DNAnexus projects. Projects are claimed
+using leases that are kept alive by heartbeats, and leases held by stuck or
+dead workers expire so another worker can claim the project
+"""
+import os
+import time
+import json
+import socket
+import sqlite3
+import argparse
+import threading
+import contextlib
+import config
+import duty_csv
+from logger import Logger
+from rate_limiter import RateLimiter
+
+# Configured by logger.Logger when the worker is started
+logger = duty_csv.logger
+
+
+class WorkQueue:
+    """
+    SQLite-backed queue of DNAnexus projects awaiting processing. Claims are
+    made inside write transactions, so only one worker can hold the lease
+    for a project. Before sending the email, the worker takes a separate
+    sending lease on it, and the project is only marked as emailed once the
+    email has been sent. A sending lease held by a worker that died while
+    sending expires, so the email is sent by the worker that reprocesses the
+    project. The email is therefore not lost, and is only sent twice if a
+    worker dies in the moment between the mail server accepting the email
+    and the project being marked as emailed
+
+    Methods
+        connect()
+            Yield a connection to the queue database
+        enqueue()
+            Add a project to the queue, unless it has already been queued
+        claim()
+            Lease the oldest pending project, or a project whose lease has
+            expired
+        heartbeat()
+            Extend the lease held by a worker
+        claim_email()
+            Take the sending lease on the email for a project, if it has not
+            already been sent and the worker still holds the lease
+        confirm_email()
+            Mark the email for a project as sent
+        release_email()
+            Release the sending lease after a failed send so it can be retried
+        finish()
+            Record the outcome of processing a project
+        get_status()
+            Return the queue entries
+    """
+
+    def __init__(self, db_path: str):
+        """
+        Constructor for the WorkQueue class
+            :param db_path (str):   Path of the SQLite queue database
+        """
+        self.db_path = db_path
+        with self.connect() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS queue (
+                    project_id TEXT PRIMARY KEY,
+                    request TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    emailed INTEGER NOT NULL DEFAULT 0,
+                    enqueued REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    email_worker TEXT,
+                    email_lease_expires REAL
+                )
+                """
+            )
+            # Add the sending lease columns to queues created before them
+            columns = [
+                row["name"] for row in connection.execute("PRAGMA table_info(queue)")
+            ]
+            for column in ("email_worker TEXT", "email_lease_expires REAL"):
+                if column.split()[0] not in columns:
+                    connection.execute(f"ALTER TABLE queue ADD COLUMN {column}")
+
+    @contextlib.contextmanager
+    def connect(self) -> sqlite3.Connection:
+        """
+        Yield a connection to the queue database in autocommit mode, closing
+        it afterwards
+            :return connection (obj):   SQLite connection object
+        """
+        connection = sqlite3.connect(
+            self.db_path, timeout=config.QUEUE_DB_TIMEOUT, isolation_level=None
+        )
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def enqueue(self, request: dict) -> bool:
+        """
+        Add a project to the queue, unless it has already been queued
+            :param request (dict):  Run request containing the GenerateOutput
+                                    arguments for the project
+            :return (bool):         True if the project was added
+        """
+        now = time.time()
+        with self.connect() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO queue (project_id, request, enqueued, updated) "
+                "VALUES (?, ?, ?, ?)",
+                (request["project_id"], json.dumps(request), now, now),
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, worker: str) -> dict | None:
+        """
+        Lease the oldest pending project, or a project whose lease has expired
+        because its worker stopped sending heartbeats. Expired projects that
+        have reached the config-defined number of attempts are marked as
+        failed rather than claimed, so a project that keeps crashing its
+        worker is not retried indefinitely
+            :param worker (str):        Worker ID
+            :return (dict | None):      Run request for the claimed project,
+                                        or None if there is nothing to claim
+        """
+        now = time.time()
+        with self.connect() as connection:
+            # Take the write lock before selecting so claims cannot interleave
+            connection.execute("BEGIN IMMEDIATE")
+            for failed in connection.execute(
+                "SELECT project_id FROM queue WHERE state = 'leased' "
+                "AND lease_expires < ? AND attempts >= ?",
+                (now, config.QUEUE_MAX_ATTEMPTS),
+            ).fetchall():
+                logger.error(
+                    f"Lease on {failed['project_id']} has expired after "
+                    f"{config.QUEUE_MAX_ATTEMPTS} attempts. Marked as failed"
+                )
+                connection.execute(
+                    "UPDATE queue SET state = 'failed', worker = NULL, "
+                    "lease_expires = NULL, updated = ? WHERE project_id = ?",
+                    (now, failed["project_id"]),
+                )
+            row = connection.execute(
+                "SELECT project_id, request, worker FROM queue "
+                "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                "ORDER BY enqueued LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row:
+                if row["worker"]:
+                    logger.warning(
+                        f"Lease held by {row['worker']} on {row['project_id']} "
+                        "has expired"
+                    )
+                connection.execute(
+                    "UPDATE queue SET state = 'leased', worker = ?, "
+                    "lease_expires = ?, attempts = attempts + 1, updated = ? "
+                    "WHERE project_id = ?",
+                    (worker, now + config.QUEUE_LEASE, now, row["project_id"]),
+                )
+            connection.execute("COMMIT")
+        return json.loads(row["request"]) if row else None
+
+    def heartbeat(self, project_id: str, worker: str) -> bool:
+        """
+        Extend the lease held by a worker
+            :param project_id (str):    DNAnexus project ID
+            :param worker (str):        Worker ID
+            :return (bool):             False if the worker no longer holds
+                                        the lease
+        """
+        now = time.time()
+        with self.connect() as connection:
+            cursor = connection.execute(
+                "UPDATE queue SET lease_expires = ?, updated = ? "
+                "WHERE project_id = ? AND worker = ? AND state = 'leased'",
+                (now + config.QUEUE_LEASE, now, project_id, worker),
+            )
+        return cursor.rowcount == 1
+
+    def claim_email(self, project_id: str, worker: str) -> bool:
+        """
+        Take the sending lease on the email for a project, if it has not
+        already been sent, no other worker holds an unexpired sending lease,
+        and the worker still holds the lease on the project
+            :param project_id (str):    DNAnexus project ID
+            :param worker (str):        Worker ID
+            :return (bool):             True if the worker should send the
+                                        email
+        """
+        now = time.time()
+        with self.connect() as connection:
+            cursor = connection.execute(
+                "UPDATE queue SET email_worker = ?, email_lease_expires = ?, "
+                "updated = ? WHERE project_id = ? AND worker = ? "
+                "AND state = 'leased' AND emailed = 0 "
+                "AND (email_worker IS NULL OR email_lease_expires < ?)",
+                (worker, now + config.QUEUE_EMAIL_LEASE, now, project_id, worker, now),
+            )
+        return cursor.rowcount == 1
+
+    def confirm_email(self, project_id: str, worker: str) -> None:
+        """
+        Mark the email for a project as sent, releasing the sending lease
+            :param project_id (str):    DNAnexus project ID
+            :param worker (str):        Worker ID
+        """
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE queue SET emailed = 1, email_worker = NULL, "
+                "email_lease_expires = NULL, updated = ? "
+                "WHERE project_id = ? AND email_worker = ?",
+                (time.time(), project_id, worker),
+            )
+
+    def release_email(self, project_id: str, worker: str) -> None:
+        """
+        Release the sending lease held by a worker after a failed send, so
+        the email can be retried
+            :param project_id (str):    DNAnexus project ID
+            :param worker (str):        Worker ID
+        """
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE queue SET email_worker = NULL, email_lease_expires = NULL, "
+                "updated = ? WHERE project_id = ? AND email_worker = ? "
+                "AND emailed = 0",
+                (time.time(), project_id, worker),
+            )
+
+    def finish(self, project_id: str, worker: str, succeeded: bool) -> None:
+        """
+        Record the outcome of processing a project. Failed projects are
+        returned to the queue until the config-defined number of attempts is
+        reached
+            :param project_id (str):    DNAnexus project ID
+            :param worker (str):        Worker ID
+            :param succeeded (bool):    True if the project was processed
+        """
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE queue SET state = CASE WHEN ? THEN 'done' "
+                "WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_expires = NULL, updated = ? "
+                "WHERE project_id = ? AND worker = ?",
+                (
+                    succeeded,
+                    config.QUEUE_MAX_ATTEMPTS,
+                    time.time(),
+                    project_id,
+                    worker,
+                ),
+            )
+
+    def get_status(self) -> list:
+        """
+        Return the queue entries
+            :return (list): List of dicts, one per queued project
+        """
+        with self.connect() as connection:
+            return [
+                dict(row)
+                for row in connection.execute(
+                    "SELECT project_id, state, worker, attempts, emailed, "
+                    "email_worker FROM queue ORDER BY enqueued"
+                )
+            ]
+
+
+class QueuedOutput(duty_csv.GenerateOutput):
+    """
+    GenerateOutput for a project claimed from the work queue. The email is
+    only sent if it has not already been sent for the project
+
+    Methods
+        send_email()
+            Send the email if this worker holds the project's sending lease
+    """
+
+    def __init__(self, queue: WorkQueue, worker: str, *args, **kwargs):
+        """
+        Constructor for the QueuedOutput class
+            :param queue (obj):     WorkQueue object
+            :param worker (str):    Worker ID
+        """
+        self.queue = queue
+        self.worker = worker
+        super().__init__(*args, **kwargs)
+
+    def send_email(self) -> None:
+        """
+        Send the email if this worker holds the project's sending lease. The
+        project is marked as emailed once the email has been sent, and the
+        sending lease is released if the email could not be sent
+        """
+        if not self.queue.claim_email(self.project_id, self.worker):
+            logger.info(
+                f"Email not sent as it has already been sent for {self.project_id}"
+            )
+            return
+        try:
+            super().send_email()
+        except SystemExit:
+            self.queue.release_email(self.project_id, self.worker)
+            raise
+        self.queue.confirm_email(self.project_id, self.worker)
+
+
+class Worker:
+    """
+    Claim projects from the work queue and process them using GenerateOutput,
+    sending heartbeats on a background thread while each project is processed
+
+    Methods
+        run()
+            Process projects until the queue is empty, or indefinitely
+        process()
+            Process a single claimed project
+        send_heartbeats()
+            Extend the lease until processing has finished
+    """
+
+    def __init__(self, queue: WorkQueue, email_user: str, email_pw: str):
+        """
+        Constructor for the Worker class
+            :param queue (obj):         WorkQueue object
+            :param email_user (str):    Mail server username
+            :param email_pw (str):      Mail server password
+        """
+        self.queue = queue
+        self.email_user = email_user
+        self.email_pw = email_pw
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def run(self, drain: bool) -> None:
+        """
+        Process projects until the queue is empty, or poll indefinitely
+            :param drain (bool):    Exit once there is nothing left to claim
+        """
+        logger.info(f"Worker {self.worker_id} started")
+        while True:
+            request = self.queue.claim(self.worker_id)
+            if request:
+                self.process(request)
+            elif drain:
+                logger.info("No projects left to claim")
+                return
+            else:
+                time.sleep(config.QUEUE_POLL_INTERVAL)
+
+    def process(self, request: dict) -> None:
+        """
+        Process a single claimed project
+            :param request (dict):  Run request for the project
+        """
+        project_id = request["project_id"]
+        logger.info(f"Worker {self.worker_id} claimed {project_id}")
+        finished = threading.Event()
+        heartbeats = threading.Thread(
+            target=self.send_heartbeats, args=(project_id, finished), daemon=True
+        )
+        heartbeats.start()
+        try:
+            QueuedOutput(
+                self.queue,
+                self.worker_id,
+                request["project_name"],
+                project_id,
+                self.email_user,
+                self.email_pw,
+                request["stg_pannumbers"],
+                request["cp_capture_pannos"],
+                request["mode"],
+                runtype_downloads=duty_csv.update_tso_config_regex(
+                    request["tso_pannumbers"]
+                ),
+                tso_pannumbers=request["tso_pannumbers"],
+            )
+            succeeded = True
+        except SystemExit as exception:
+            # Partial outputs were emailed, and the missing URLs can be
+            # created in refresh mode, so the project is not retried
+            succeeded = exception.code == config.DEADLINE_EXIT_CODE
+        except Exception as exception:
+            logger.error(f"Processing {project_id} failed, with exception: {exception}")
+            succeeded = False
+        finished.set()
+        heartbeats.join()
+        self.queue.finish(project_id, self.worker_id, succeeded)
+        logger.info(
+            f"Worker {self.worker_id} {'completed' if succeeded else 'failed'} "
+            f"{project_id}"
+        )
+
+    def send_heartbeats(self, project_id: str, finished: threading.Event) -> None:
+        """
+        Extend the lease until processing has finished
+            :param project_id (str):    DNAnexus project ID
+            :param finished (obj):      Event set when processing has finished
+        """
+        while not finished.wait(config.QUEUE_HEARTBEAT_INTERVAL):
+            if not self.queue.heartbeat(project_id, self.worker_id):
+                logger.warning(f"Worker {self.worker_id} lost lease on {project_id}")
+                return
+
+
+def arg_parse() -> dict:
+    """
+    Parse arguments supplied by the command line. Create argument parser,
+    define command line arguments, then parse supplied command line arguments
+    using the created argument parser
+        :return (dict): Parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description="Queue DNAnexus projects and process them using workers"
+    )
+    parser.add_argument(
+        "-Q",
+        "--queue",
+        type=str,
+        help="Path of the SQLite queue database",
+        default=os.path.join(os.getcwd(), config.QUEUE_DB),
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = subparsers.add_parser("enqueue", help="Add a project to the queue")
+    enqueue.add_argument(
+        "-P",
+        "--project_name",
+        type=str,
+        help="Name of project to obtain download links from",
+        required=True,
+    )
+    enqueue.add_argument(
+        "-I",
+        "--project_id",
+        type=str,
+        help="ID of project to obtain download links from",
+        required=True,
+    )
+    enqueue.add_argument(
+        "-TP",
+        "--tso_pannumbers",
+        type=str,
+        help="Space separated pan numbers",
+        required=True,
+        nargs="+",
+    )
+    enqueue.add_argument(
+        "-SP",
+        "--stg_pannumbers",
+        type=str,
+        help="Space separated pan numbers",
+        required=True,
+        nargs="+",
+    )
+    enqueue.add_argument(
+        "-CP",
+        "--cp_capture_pannos",
+        type=str,
+        help="Synnovis Custom Panels whole capture pan numbers, space separated",
+        required=True,
+        nargs="+",
+    )
+    enqueue.add_argument(
+        "-T",
+        "--testing",
+        action="store_true",
+        help="Test mode",
+        default=False,
+    )
+
+    work = subparsers.add_parser("work", help="Process projects from the queue")
+    work.add_argument(
+        "-EU",
+        "--email_user",
+        type=str,
+        help="Username for mail server",
+        required=True,
+    )
+    work.add_argument(
+        "-PW",
+        "--email_pw",
+        type=str,
+        help="Password for mail server",
+        required=True,
+    )
+    work.add_argument(
+        "--drain",
+        action="store_true",
+        help="Exit once there are no projects left to claim",
+        default=False,
+    )
+
+    subparsers.add_parser("status", help="Print the queue entries")
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    queue = WorkQueue(args["queue"])
+
+    if args["command"] == "enqueue":
+        request = {
+            key: args[key]
+            for key in (
+                "project_name",
+                "project_id",
+                "tso_pannumbers",
+                "stg_pannumbers",
+                "cp_capture_pannos",
+            )
+        }
+        request["mode"] = "TEST" if args["testing"] else "PROD"
+        if queue.enqueue(request):
+            print(f"Queued {args['project_id']}")
+        else:
+            print(f"{args['project_id']} has already been queued")
+
+    elif args["command"] == "status":
+        for entry in queue.get_status():
+            print(json.dumps(entry))
+
+    else:
+        logger = Logger(
+            os.path.join(
+                os.getcwd(),
+                f"duty_csv_worker.{socket.gethostname()}.{os.getpid()}.log",
+            )
+        ).logger
+        logger.info(f"Running duty_csv worker {duty_csv.git_tag()}")
+        if config.DX_RATE_LIMIT:
+            RateLimiter(
+                os.path.join(os.getcwd(), config.DX_RATE_LIMIT_DB),
+                config.DX_RATE_LIMIT,
+                config.DX_RATE_BURST,
+            ).install()
+        duty_csv.authenticate_dxpy()
+        Worker(queue, args["email_user"], args["email_pw"]).run(args["drain"])